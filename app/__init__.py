@@ -1,8 +1,9 @@
 import os
+import sys
 from flask import Flask
 from flask_cors import CORS
 from app.models import LoginUser
-from app.extensions import redis_db, sqlite_db, login_manager, bcrypt, scheduler, storage_client, fc_handler, limiter
+from app.extensions import redis_db, mtime_store, sqlite_db, login_manager, bcrypt, scheduler, storage_client, fc_handler, limiter
 from app.views import auth_bp, monitor_bp, files_bp, index_bp, logs_bp
 from app.database import User, MonitoredFolder
 from app.utils import folder_scan, create_folder_scheduler, getLogger, setLogger
@@ -13,6 +14,8 @@ from app.config import DevConfig, ProductionConfig
 logger = getLogger("app_init")
 
 FLASK_DEBUG = os.getenv('FLASK_DEBUG', '0') == '1'
+# celery worker、beat、flower同样会导入并初始化app
+IS_CELERY_PROCESS = os.path.basename(sys.argv[0]) == 'celery' or sys.argv[0].endswith(os.path.join('celery', '__main__.py'))
 if FLASK_DEBUG:
     cfg = DevConfig()
 else:
@@ -65,17 +68,18 @@ def register_extensions(app):
         sqlite_db.create_all()
     # redis_db.init_app(app, charset="utf-8", decode_responses=True)
     redis_db.init_app(app, decode_responses=True)
+    mtime_store.init_app(app, redis_db)
     bcrypt.init_app(app)
 
     # 注册定时任务调度器
     scheduler.init_app(app)
     scheduler.start()
     # 注册存储客户端
-    storage_client.init_app(app)
+    storage_client.init_app(app, redis_db)
     # 注册celery
     # celery_wrapper.init_app(app)
     # 注册文件变更处理器
-    fc_handler.init_app(app)
+    fc_handler.init_app(app, redis_db)
     # 注册请求频率限制
     limiter.init_app(app)
 
@@ -116,6 +120,13 @@ def init_launch(app):
     else:
         # logger.warning(f"启动时不更新目录的mtime...")
         pass
+    # 一次性迁移旧版的mtime存储格式，仅由web进程执行，celery进程等待迁移完成后再使用mtime
+    if not IS_CELERY_PROCESS:
+        migrated = mtime_store.migrate_legacy_layout()
+        if migrated > 0:
+            logger.warning(f"已将{migrated}个目录的mtime迁移到新的存储格式")
+    elif not mtime_store.wait_layout_migrated():
+        logger.error("等待mtime存储格式迁移超时，请确认web进程已启动")
     servers_cfg = app.config['MEDIA_SERVERS']
     for _monitor in monitored_folders:
         if fetch_mtime_only:
@@ -124,7 +135,7 @@ def init_launch(app):
                 _monitor.blacklist,
                 servers_cfg=servers_cfg,
                 storage_client=storage_client,
-                db=redis_db,
+                db=mtime_store,
                 fetch_mtime_only=fetch_mtime_only,
                 fetch_all_mode=fetch_all_mode,
             )
@@ -133,7 +144,7 @@ def init_launch(app):
             servers_cfg=servers_cfg,
             scheduler=scheduler,
             storage_client=storage_client,
-            db=redis_db,
+            db=mtime_store,
             fetch_mtime_only=fetch_mtime_only,
             fetch_all_mode=fetch_all_mode,
         )
@@ -162,6 +173,14 @@ def celery_init_app(app: Flask) -> Celery:
             'interval_max': 30,
         },
     )
+    # 定时处理积压及worker中途退出遗留的文件变更事件
+    if fc_handler.stream is not None:
+        celery_app.conf.beat_schedule = {
+            'consume-filechange-events': {
+                'task': 'app.tasks.consume_filechange_events',
+                'schedule': fc_handler.stream_recover_interval,
+            },
+        }
     celery_app.autodiscover_tasks()
     celery_app.set_default()
     app.extensions["celery"] = celery_app
@@ -1,5 +1,5 @@
 import os
-from app.utils import YAMLLoader, read_deepvalue, str2bool, dict2obj
+from app.utils import YAMLLoader, read_deepvalue, str2bool, dict2obj, timeparse
 
 
 app_dir = os.path.dirname(os.path.abspath(__file__))  # This directory
@@ -36,6 +36,7 @@ class BaseConfig(object):
         self.REDIS_URL = f'redis://{redis_username}:{redis_password}@{redis_host}:{redis_port}/{redis_db}'
         self.REDIS_SOCKET_TIMEOUT = int(read_deepvalue(self._config, 'databases', 'redis', 'socket_timeout'))
         self.REDIS_CONNECTION_POOL = str2bool(read_deepvalue(self._config, 'databases', 'redis', 'pool_enabled'))
+        self.REDIS_BATCH_SIZE = int(read_deepvalue(self._config, 'databases', 'redis', 'batch_size') or 500)
         # Celery
         celery_broker_db = read_deepvalue(self._config, 'databases', 'redis', 'celery_broker_db')
         celery_result_db = read_deepvalue(self._config, 'databases', 'redis', 'celery_result_db')
@@ -83,7 +84,60 @@ class BaseConfig(object):
         self.STORAGE_HOST = read_deepvalue(storage_providers, self.STORAGE_PROVIDER, 'host')
         self.STORAGE_USERNAME = read_deepvalue(storage_providers, self.STORAGE_PROVIDER, 'username')
         self.STORAGE_PASSWORD = read_deepvalue(storage_providers, self.STORAGE_PROVIDER, 'password')
+        self.STORAGE_MAX_CONCURRENT_LISTINGS = int(
+            read_deepvalue(storage_providers, self.STORAGE_PROVIDER, 'max_concurrent_listings') or 1
+        )
+        # 网盘接口的自适应限流
+        rate_control = read_deepvalue(storage_providers, self.STORAGE_PROVIDER, 'rate_control') or {}
+        self.STORAGE_RATE_CONTROL_ENABLED = str2bool(rate_control.get('enabled', True))
+        self.STORAGE_RATE_CONTROL_MIN_CONCURRENCY = int(rate_control.get('min_concurrency', 1))
+        self.STORAGE_RATE_CONTROL_MAX_CONCURRENCY = int(
+            rate_control.get('max_concurrency', max(8, self.STORAGE_MAX_CONCURRENT_LISTINGS))
+        )
+        self.STORAGE_RATE_CONTROL_MIN_RATE = float(rate_control.get('min_rate', 1))
+        self.STORAGE_RATE_CONTROL_MAX_RATE = float(rate_control.get('max_rate', 0))
+        self.STORAGE_RATE_CONTROL_INCREASE_STEP = float(rate_control.get('increase_step', 1))
+        self.STORAGE_RATE_CONTROL_DECREASE_FACTOR = float(rate_control.get('decrease_factor', 0.5))
+        self.STORAGE_RATE_CONTROL_COOLDOWN = timeparse(str(rate_control.get('cooldown', '5s')))
+        self.STORAGE_RATE_CONTROL_MAX_WAIT = timeparse(str(rate_control.get('max_wait', '5m')))
+        self.STORAGE_RATE_CONTROL_MAX_RETRIES = int(rate_control.get('max_retries', 3))
+        self.STORAGE_RATE_CONTROL_THROTTLE_KEYWORDS = rate_control.get('throttle_keywords', None)
+        # 网盘接口（attr、listdir_attr、exists）结果的缓存
+        storage_cache = read_deepvalue(storage_providers, self.STORAGE_PROVIDER, 'cache') or {}
+        storage_cache_ttl = storage_cache.get('ttl', {}) or {}
+        self.STORAGE_CACHE_ENABLED = str2bool(storage_cache.get('enabled', True))
+        self.STORAGE_CACHE_MAX_ENTRIES = int(storage_cache.get('max_entries', 10000))
+        self.STORAGE_CACHE_TTLS = {
+            method: timeparse(str(storage_cache_ttl.get(method, '30s'))) or 0
+            for method in ('attr', 'listdir_attr', 'exists')
+        }
+        self.STORAGE_CACHE_SYNC_INTERVAL = timeparse(str(storage_cache.get('sync_interval', '2s'))) or 0
         self.MEDIA_SERVERS = read_deepvalue(self._config, 'media_servers')
+        # 定时遍历监控目录的配置
+        self.FOLDER_MONITOR_SNAPSHOT_ENABLED = str2bool(
+            read_deepvalue(self._config, 'folder_monitor', 'snapshot', 'enabled') or False
+        )
+        self.FOLDER_MONITOR_PRUNE_UNCHANGED_SUBTREES = str2bool(
+            read_deepvalue(self._config, 'folder_monitor', 'snapshot', 'prune_unchanged_subtrees') or False
+        )
+        self.FOLDER_MONITOR_ADAPTIVE_POLLING_ENABLED = str2bool(
+            read_deepvalue(self._config, 'folder_monitor', 'adaptive_polling', 'enabled') or False
+        )
+        self.FOLDER_MONITOR_MIN_STALENESS = timeparse(
+            str(read_deepvalue(self._config, 'folder_monitor', 'adaptive_polling', 'min_staleness') or '1h')
+        )
+        self.FOLDER_MONITOR_MAX_STALENESS = timeparse(
+            str(read_deepvalue(self._config, 'folder_monitor', 'adaptive_polling', 'max_staleness') or '7d')
+        )
+        self.FOLDER_MONITOR_CHECKPOINT_ENABLED = str2bool(
+            read_deepvalue(self._config, 'folder_monitor', 'checkpoint', 'enabled') or False
+        )
+        self.FOLDER_MONITOR_CHECKPOINT_INTERVAL = timeparse(
+            str(read_deepvalue(self._config, 'folder_monitor', 'checkpoint', 'interval') or '5m')
+        )
+        self.FOLDER_MONITOR_CHECKPOINT_MAX_AGE = timeparse(
+            str(read_deepvalue(self._config, 'folder_monitor', 'checkpoint', 'max_age') or '3d')
+        )
         self.UPDATE_MTIME_ON_STARTUP = str2bool(os.getenv('UPDATE_MTIME_ON_STARTUP', 'False'))
         self.UPDATE_MTIME_OF_ALL = str2bool(os.getenv('UPDATE_MTIME_OF_ALL', 'False'))
         # 文件变更处理器的配置
@@ -92,6 +146,20 @@ class BaseConfig(object):
             self._config, 'flask', 'filechangehandler', 'allowed_path_keywords'
         )
         self.FC_HANDLER_TIMER_INTERVAL = read_deepvalue(self._config, 'flask', 'filechangehandler', 'timer_interval')
+        self.FC_HANDLER_MAX_WAIT = int(read_deepvalue(self._config, 'flask', 'filechangehandler', 'max_wait') or 0)
+        self.FC_HANDLER_MAX_BATCH_SIZE = int(
+            read_deepvalue(self._config, 'flask', 'filechangehandler', 'max_batch_size') or 0
+        )
+        self.FC_HANDLER_COLLAPSE_SIBLINGS_THRESHOLD = int(
+            read_deepvalue(self._config, 'flask', 'filechangehandler', 'collapse_siblings_threshold') or 0
+        )
+        # 文件变更事件写入redis stream，由celery worker处理
+        fc_stream = read_deepvalue(self._config, 'flask', 'filechangehandler', 'stream') or {}
+        self.FC_HANDLER_STREAM_ENABLED = str2bool(fc_stream.get('enabled', False))
+        self.FC_HANDLER_STREAM_MAX_LEN = int(fc_stream.get('max_len', 100000))
+        self.FC_HANDLER_STREAM_CLAIM_IDLE = timeparse(str(fc_stream.get('claim_idle', '10m'))) or 600
+        self.FC_HANDLER_STREAM_MAX_DELIVERIES = int(fc_stream.get('max_deliveries', 5))
+        self.FC_HANDLER_STREAM_RECOVER_INTERVAL = timeparse(str(fc_stream.get('recover_interval', '1m'))) or 60
         self.FC_HANDLER_SYNC_OTHER_DEVICE_ENABLED = str2bool(
             read_deepvalue(self._config, 'flask', 'filechangehandler', 'sync_other_device_enabled')
         )
@@ -7,11 +7,12 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 
-from app.utils import FlaskStorageClientWrapper, FlaskFileChangeHandlerWrapper
+from app.utils import FlaskStorageClientWrapper, FlaskFileChangeHandlerWrapper, FlaskMtimeStoreWrapper
 
 
 sqlite_db = SQLAlchemy()
 redis_db = FlaskRedis()
+mtime_store = FlaskMtimeStoreWrapper()
 login_manager = LoginManager()
 scheduler = APScheduler()
 bcrypt = Bcrypt()
@@ -1,6 +1,17 @@
+from flask import current_app
 from celery import shared_task
-from app.utils import getLogger, folder_scan, manual_scan
-from app.extensions import redis_db, storage_client, fc_handler
+from app.utils import (
+    getLogger,
+    folder_scan,
+    manual_scan,
+    manual_scan_dest_pathlist,
+    manual_scan_deleted_pathlist,
+    manual_scan_moved_pathlist,
+    DirectorySnapshot,
+    AdaptivePolling,
+    ScanCheckpoint,
+)
+from app.extensions import mtime_store, storage_client, fc_handler
 
 
 logger = getLogger(__name__)
@@ -15,7 +26,7 @@ def mtime_updating(self, folder, blacklist, servers_cfg, fetch_mtime_only, fetch
             blacklist,
             servers_cfg,
             storage_client=storage_client,
-            db=redis_db,
+            db=mtime_store,
             fetch_mtime_only=fetch_mtime_only,
             fetch_all_mode=fetch_all_mode,
             this_logger=logger,
@@ -28,16 +39,19 @@ def mtime_updating(self, folder, blacklist, servers_cfg, fetch_mtime_only, fetch
 @shared_task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 5})
 def mtime_clearing(self, folder):
     try:
-        for k in redis_db.scan_iter(match=f"{folder}*"):
-            redis_db.delete(k)
-        logger.warning(f"目录[{folder}]的mtime清空任务完成!")
+        cleared = mtime_store.clear_subtree(folder)
+        # 快照、自适应间隔、检查点都依赖于已清空的mtime，一并丢弃，下一次遍历时完整遍历
+        DirectorySnapshot.discard_overlapping(mtime_store, folder)
+        AdaptivePolling.discard_overlapping(mtime_store, folder)
+        ScanCheckpoint.discard_overlapping(mtime_store, folder)
+        logger.warning(f"目录[{folder}]的mtime清空任务完成! 共清空{cleared}个目录")
     except Exception as e:
         raise Exception(f"目录[{folder}]的mtime清空任务失败! 错误信息: {e}")
 
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 5})
 def manual_scan_bg(self, folder, servers_cfg):
-    rval, message = manual_scan(folder, servers_cfg, storage_client, redis_db)
+    rval, message = manual_scan(folder, servers_cfg, storage_client, mtime_store)
     if rval:
         logger.info(f"手动扫描路径[{folder}]完成!")
     else:
@@ -49,3 +63,54 @@ def async_filechange_to_other_device(self, upstream_url, payload):
     rmsg = fc_handler.sync_filechange_to_other_device(upstream_url, payload)
     if rmsg:
         logger.warning(rmsg)
+
+
+@shared_task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 5})
+def consume_filechange_events(self):
+    '''
+    从redis stream读取文件变更事件，合并后生成strm并通知媒体服务器扫描，处理完成后再确认
+    '''
+    stream = fc_handler.stream
+    if stream is None:
+        return
+    consumer = stream.consumer_name()
+    servers_cfg = current_app.config['MEDIA_SERVERS']
+    processed = 0
+    while True:
+        # 优先处理本进程上次处理失败（celery重试）及中途退出的worker遗留的事件，保持与后续新事件的先后顺序
+        entries = stream.claim_own_pending(consumer) or stream.claim_stale(consumer) or stream.read(consumer)
+        if not entries:
+            break
+        if len(entries) >= stream.batch_size:
+            # 积压较多时调度其他worker并行处理
+            consume_filechange_events.apply_async()
+        events = dict(entries)
+        # 按段依次处理并确认，同一路径上的变更保持stream中的先后顺序
+        for segment in fc_handler.segment_events(entries):
+            failed_ids = process_filechange_segment(segment, servers_cfg)
+            stream.dead_letter([(entry_id, events[entry_id]) for entry_id in failed_ids], "处理失败")
+            stream.ack([entry_id for entry_id in segment['ids'] if entry_id not in failed_ids])
+            processed += len(segment['ids'])
+    if processed > 0:
+        logger.warning(f"已处理{processed}个文件变更事件")
+
+
+def process_filechange_segment(segment, servers_cfg):
+    '''
+    处理一段合并后的文件变更，返回处理失败的事件id
+    '''
+    if segment['moves']:
+        manual_scan_moved_pathlist(segment['moves'], servers_cfg, storage_client, mtime_store, this_logger=logger)
+    if segment['deletes']:
+        manual_scan_deleted_pathlist(segment['deletes'], servers_cfg, storage_client, mtime_store, this_logger=logger)
+    failed_paths = []
+    if segment['creates']:
+        failed_paths = manual_scan_dest_pathlist(
+            segment['creates'], servers_cfg, storage_client, mtime_store, this_logger=logger
+        )
+    # 合并后的路径失败时，被其覆盖的新增事件均视为失败
+    return {
+        entry_id
+        for entry_id, path in segment['create_paths'].items()
+        if any(path == f or path.startswith(f.rstrip('/') + '/') for f in failed_paths)
+    }
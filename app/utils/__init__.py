@@ -1,6 +1,6 @@
 from .yaml_loader import YAMLLoader
 from .logger import getLogger, setLogger
-from .others import read_deepvalue, str2bool, timestamp_to_datetime
+from .others import read_deepvalue, str2bool, timestamp_to_datetime, seconds_to_readable
 from .schema import (
     get_valid_interval,
     MonitoredFolderDataSchema,
@@ -11,15 +11,31 @@ from .schema import (
 )
 
 from .data_types import Json
+from .snapshot import DirectorySnapshot
+from .adaptive_polling import AdaptivePolling
+from .checkpoint import ScanCheckpoint
+from .scan_lock import ScanLock, ScanLockLost
+from .rate_control import AdaptiveRateController
+from .path_trie import PathTrie, PathMapper, coalesce_paths
+from .media_client import MediaServerClient, CircuitOpenError, get_media_client, media_clients_stats
+from .strm_manifest import StrmManifest
+from .download_queue import MetadataDownloadQueue
+from .event_stream import FileChangeStream
 
-from .extra_extensions import FlaskStorageClientWrapper, FlaskCeleryWrapper, FlaskFileChangeHandlerWrapper
-from .scanner import PlexScanner, EmbyScanner
+from .extra_extensions import (
+    FlaskStorageClientWrapper,
+    FlaskCeleryWrapper,
+    FlaskFileChangeHandlerWrapper,
+    FlaskMtimeStoreWrapper,
+)
+from .scanner import PlexScanner, EmbyScanner, scanner_registry
 from .folder_monitor import (
     create_folder_scheduler,
     manual_scan,
     folder_scan,
     manual_scan_dest_pathlist,
     manual_scan_deleted_pathlist,
+    manual_scan_moved_pathlist,
 )
 from .sort import sort_list_by_pinyin, sort_list_mixedversion
 from .pytimeparse import timeparse
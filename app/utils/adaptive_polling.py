@@ -0,0 +1,119 @@
+import json
+import time
+from .others import seconds_to_readable
+from .logger import getLogger
+from .path_trie import paths_overlap
+
+logger = getLogger(__name__)
+
+
+class AdaptivePolling(object):
+    '''按子树（监控目录的一级子目录）记录变更频率，自适应调整各子树的遍历间隔：
+    子树发生变更时间隔重置为min_staleness，未变更时间隔翻倍，最长为max_staleness；
+    每次遍历只进入到期的子树，或者在监控目录的listdir中mtime已经变化的子树。
+    状态保存在redis哈希表 {KEY_PREFIX}:{root} 中，子树 -> json
+    '''
+
+    KEY_PREFIX = 'adaptive'
+
+    def __init__(self, store, root, storage_client, min_staleness, max_staleness):
+        self.store = store
+        self.root = root
+        self.storage_client = storage_client
+        self.min_staleness = min_staleness
+        self.max_staleness = max(min_staleness, max_staleness)
+        self.key = f"{self.KEY_PREFIX}:{root}"
+        self.states = {}
+        self.visited = {}
+        self.changed = set()
+        self.skipped = 0
+
+    def load(self):
+        self.store.count_round_trip()
+        self.states = {k: json.loads(v) for k, v in self.store.db.hgetall(self.key).items()}
+        self.visited.clear()
+        self.changed.clear()
+        self.skipped = 0
+        return len(self.states)
+
+    def subtree_of(self, path):
+        prefix = self.root.rstrip('/') + '/'
+        if not path.startswith(prefix):
+            return None
+        return prefix + path[len(prefix) :].split('/', 1)[0]
+
+    def should_descend(self, dir_attr, subs, child_attr):
+        '''只对监控目录的一级子目录做判断，更深的目录跟随其所在的子树'''
+        if dir_attr['path'] != self.root:
+            return True
+        path = child_attr['path']
+        mtime = self.storage_client.attr_mtime(child_attr)
+        state = self.states.get(path)
+        if state is not None and time.time() < state['next_due'] and state['mtime'] == mtime:
+            self.skipped += 1
+            return False
+        self.visited[path] = mtime
+        return True
+
+    def mark_changed(self, path):
+        subtree = self.subtree_of(path)
+        if subtree is not None:
+            self.changed.add(subtree)
+
+    def dump_state(self):
+        return {'visited': self.visited, 'changed': list(self.changed), 'skipped': self.skipped}
+
+    def load_state(self, state):
+        self.visited.update(state['visited'])
+        self.changed.update(state['changed'])
+        self.skipped += state['skipped']
+
+    def commit(self):
+        '''根据本次遍历的结果更新已遍历子树的间隔'''
+        if not self.visited:
+            return
+        now = time.time()
+        mapping = {}
+        for path, mtime in self.visited.items():
+            state = self.states.get(path, {'interval': self.min_staleness, 'changes': 0, 'last_change': None})
+            if path in self.changed:
+                interval = self.min_staleness
+                state['changes'] += 1
+                state['last_change'] = now
+            else:
+                interval = min(state['interval'] * 2, self.max_staleness)
+            state.update(interval=max(interval, self.min_staleness), next_due=now + interval, mtime=mtime)
+            self.states[path] = state
+            mapping[path] = json.dumps(state)
+        self.store.count_round_trip()
+        self.store.db.hset(self.key, mapping=mapping)
+        self.visited.clear()
+        self.changed.clear()
+
+    def describe(self, top_n=5):
+        '''用于监控列表展示的学习到的间隔'''
+        if not self.states:
+            self.load()
+        if not self.states:
+            return "-", ""
+        intervals = sorted(s['interval'] for s in self.states.values())
+        summary = (
+            f"{len(intervals)}个子树: {seconds_to_readable(intervals[0])}~{seconds_to_readable(intervals[-1])}"
+        )
+        hottest = sorted(self.states.items(), key=lambda x: (x[1]['interval'], -x[1]['changes']))[:top_n]
+        detail = "\n".join(f"{p}: {seconds_to_readable(s['interval'])}" for p, s in hottest)
+        return summary, detail
+
+    def discard(self):
+        self.store.count_round_trip()
+        self.store.db.delete(self.key)
+        self.states.clear()
+
+    @classmethod
+    def discard_overlapping(cls, store, folder):
+        '''丢弃与folder有重叠的监控目录的自适应间隔，下一次遍历时会进入所有子树'''
+        for key in store.db.scan_iter(match=f"{cls.KEY_PREFIX}:*"):
+            root = key[len(cls.KEY_PREFIX) + 1 :]
+            if paths_overlap(root, folder):
+                store.db.delete(key)
+                logger.info(f"已丢弃目录[{root}]的自适应遍历间隔")
@@ -0,0 +1,126 @@
+import time
+import posixpath
+import threading
+from collections import OrderedDict
+from .path_trie import PathTrie
+
+
+class AttrCache(object):
+    '''网盘接口结果的缓存：键为(接口, 路径)，按接口设置过期时间（秒，0表示不缓存该接口），
+    超过max_entries时淘汰最久未使用的条目。文件变更时使路径本身及其祖先的条目失效，recursive时同时使其子孙失效。
+    条目按路径建立索引（路径 -> 接口集合，及路径前缀树），失效一个路径的耗时与路径深度及其子树中的条目数成正比。
+    '''
+
+    def __init__(self, ttls, max_entries=10000):
+        self.ttls = dict(ttls)
+        self.max_entries = max(1, max_entries)
+        self.entries = OrderedDict()
+        self.methods_by_path = {}  # 路径 -> 有缓存条目的接口集合
+        self.path_trie = PathTrie()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0  # 每次失效时递增，失效之前发出的请求的结果不再写入缓存
+
+    @staticmethod
+    def normpath(path):
+        return posixpath.normpath(path) if path else path
+
+    def enabled_for(self, method):
+        return self.ttls.get(method, 0) > 0
+
+    def _index(self, key):
+        method, path = key
+        methods = self.methods_by_path.get(path)
+        if methods is None:
+            methods = self.methods_by_path[path] = set()
+            self.path_trie.insert(path)
+        methods.add(method)
+
+    def _remove(self, key):
+        del self.entries[key]
+        method, path = key
+        methods = self.methods_by_path.get(path)
+        if methods is None:
+            return
+        methods.discard(method)
+        if not methods:
+            del self.methods_by_path[path]
+            self.path_trie.remove(path)
+
+    def get(self, method, path):
+        '''返回(是否命中, 值)'''
+        key = (method, self.normpath(path))
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, method, path, value, generation=None):
+        ttl = self.ttls.get(method, 0)
+        if ttl <= 0:
+            return
+        key = (method, self.normpath(path))
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            self._index(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, path, recursive=False):
+        '''使path及其祖先（父目录的listing、mtime随之变化）的条目失效，recursive时同时使其子孙的条目失效'''
+        return self.invalidate_many([(path, recursive)])
+
+    def invalidate_many(self, items):
+        '''批量失效[(路径, recursive)]，只递增一次generation，返回失效的条目数'''
+        count = 0
+        with self._lock:
+            for path, recursive in items:
+                path = self.normpath(path)
+                paths = {path}
+                parent = posixpath.dirname(path)
+                while parent not in paths:
+                    paths.add(parent)
+                    parent = posixpath.dirname(parent)
+                if recursive:
+                    paths.update(self.path_trie.iter_under(path))
+                for p in paths:
+                    for method in list(self.methods_by_path.get(p, ())):
+                        self._remove((method, p))
+                        count += 1
+            self.invalidations += count
+            self.generation += 1
+        return count
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.methods_by_path.clear()
+            self.path_trie = PathTrie()
+            self.generation += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttls': self.ttls,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
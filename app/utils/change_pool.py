@@ -0,0 +1,79 @@
+import posixpath
+import itertools
+import threading
+from collections import OrderedDict, defaultdict
+from .path_trie import PathTrie
+
+
+class ChangePool(object):
+    '''待处理的变更路径：按加入顺序去重的集合，并用路径前缀树合并：
+    已有祖先目录待处理的路径直接吸收，新加入的目录吸收其下已待处理的路径；
+    collapse_threshold大于0时，同一父目录下待处理的路径超过该数量则合并为父目录（can_collapse(父目录)为True时）
+    '''
+
+    def __init__(self, collapse_threshold=0, can_collapse=None):
+        self.collapse_threshold = max(0, collapse_threshold)
+        self.can_collapse = can_collapse
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.paths = OrderedDict()
+        self.trie = PathTrie()
+        self.children = defaultdict(int)  # 父目录 -> 待处理的直接子路径数
+        self.events = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return posixpath.normpath(path) in self.paths
+
+    def _insert(self, path):
+        self.paths[path] = None
+        self.trie.insert(path)
+        self.children[posixpath.dirname(path)] += 1
+
+    def _discard(self, path):
+        self.paths.pop(path, None)
+        self.trie.remove(path)
+        parent = posixpath.dirname(path)
+        self.children[parent] -= 1
+        if self.children[parent] <= 0:
+            del self.children[parent]
+
+    def add(self, path):
+        '''加入路径，被已待处理的祖先目录吸收时返回False'''
+        path = posixpath.normpath(path)
+        with self._lock:
+            self.events += 1
+            if self.trie.longest_prefix(path)[0] is not None:
+                return False
+            for sub in list(self.trie.iter_under(path)):
+                self._discard(sub)
+            self._insert(path)
+            parent = posixpath.dirname(path)
+            while (
+                self.collapse_threshold > 0
+                and parent != path
+                and self.children.get(parent, 0) > self.collapse_threshold
+                and (self.can_collapse is None or self.can_collapse(parent))
+            ):
+                for sub in list(self.trie.iter_under(parent)):
+                    self._discard(sub)
+                self._insert(parent)
+                path, parent = parent, posixpath.dirname(parent)
+            return True
+
+    def drain(self, limit=0):
+        '''按加入顺序取出待处理的路径，limit大于0时最多取出limit个，返回(路径列表, 收到的变更数)'''
+        with self._lock:
+            if not limit or len(self.paths) <= limit:
+                paths, events = list(self.paths), self.events
+                self._reset()
+                return paths, events
+            paths = list(itertools.islice(self.paths, limit))
+            for path in paths:
+                self._discard(path)
+            events, self.events = self.events, 0
+        return paths, events
@@ -0,0 +1,95 @@
+import json
+import time
+from .logger import getLogger
+from .path_trie import paths_overlap
+
+logger = getLogger(__name__)
+
+
+class ScanCheckpoint(object):
+    '''遍历任务的检查点，保存在redis哈希表 {KEY_PREFIX}:{folder} 中，遍历模式 -> json：
+    包括待遍历的目录（walk frontier）、ScanningPool中待扫描的内容、快照及自适应间隔的暂存状态。
+    遍历任务中断（worker重启、cd2重连、celery重试等）后，再次执行同一目录同一模式的遍历时从检查点继续。
+    phase为PHASE_PENDING_DISPATCH时表示遍历已完成但扫描尚未成功，继续时需恢复待扫描的内容并重新遍历。
+    '''
+
+    KEY_PREFIX = 'checkpoint'
+    PHASE_WALKING = 'walking'
+    PHASE_PENDING_DISPATCH = 'pending_dispatch'
+
+    def __init__(self, store, folder, mode, interval, max_age):
+        self.store = store
+        self.folder = folder
+        self.mode = mode
+        self.interval = interval
+        self.max_age = max_age
+        self.key = f"{self.KEY_PREFIX}:{folder}"
+        self.last_saved = time.time()
+
+    def load(self):
+        self.store.count_round_trip()
+        value = self.store.db.hget(self.key, self.mode)
+        if not value:
+            return None
+        return json.loads(value)
+
+    def is_due(self):
+        return time.time() - self.last_saved >= self.interval
+
+    def save(self, frontier, pool_state, snapshot_state=None, adaptive_state=None, phase=PHASE_WALKING):
+        state = {
+            'folder': self.folder,
+            'mode': self.mode,
+            'phase': phase,
+            'saved_at': time.time(),
+            'frontier': frontier,
+            'pool': pool_state,
+            'snapshot': snapshot_state,
+            'adaptive': adaptive_state,
+        }
+        self.store.count_round_trip()
+        pipe = self.store.db.pipeline(transaction=False)
+        pipe.hset(self.key, self.mode, json.dumps(state, ensure_ascii=False))
+        pipe.expire(self.key, self.max_age)
+        pipe.execute()
+        self.last_saved = time.time()
+
+    def discard(self):
+        self.store.count_round_trip()
+        self.store.db.hdel(self.key, self.mode)
+
+    @classmethod
+    def list_all(cls, store):
+        '''列出所有检查点的概要信息'''
+        checkpoints = []
+        for key in store.db.scan_iter(match=f"{cls.KEY_PREFIX}:*"):
+            for mode, value in store.db.hgetall(key).items():
+                state = json.loads(value)
+                checkpoints.append(
+                    {
+                        'folder': state['folder'],
+                        'mode': mode,
+                        'phase': state.get('phase', cls.PHASE_WALKING),
+                        'saved_at': state['saved_at'],
+                        'frontier': len(state['frontier']),
+                        'pending_scans': len(state['pool']['pool']),
+                        'ttl': store.db.ttl(key),
+                    }
+                )
+        return checkpoints
+
+    @classmethod
+    def discard_folder(cls, store, folder):
+        '''丢弃目录的所有检查点，返回是否存在检查点'''
+        return bool(store.db.delete(f"{cls.KEY_PREFIX}:{folder}"))
+
+    @classmethod
+    def discard_overlapping(cls, store, folder):
+        '''丢弃与folder有重叠的目录的所有检查点，返回丢弃的目录数量'''
+        discarded = 0
+        for key in store.db.scan_iter(match=f"{cls.KEY_PREFIX}:*"):
+            checkpoint_folder = key[len(cls.KEY_PREFIX) + 1 :]
+            if paths_overlap(checkpoint_folder, folder) and cls.discard_folder(store, checkpoint_folder):
+                discarded += 1
+                logger.info(f"已丢弃目录[{checkpoint_folder}]的检查点")
+        return discarded
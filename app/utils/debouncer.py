@@ -0,0 +1,60 @@
+import time
+import threading
+
+
+class Debouncer(object):
+    '''合并连续的触发：距最后一次触发quiet_window秒内没有新的触发时执行；
+    max_wait大于0时，距本批第一次触发max_wait秒后无论是否仍有新的触发都执行；
+    max_batch_size大于0时，待处理的数量达到该值立即执行。执行在定时器线程中进行
+    '''
+
+    def __init__(self, quiet_window, max_wait=0, max_batch_size=0):
+        self.quiet_window = max(0, quiet_window)
+        self.max_wait = max(0, max_wait)
+        self.max_batch_size = max(0, max_batch_size)
+        self._lock = threading.Lock()
+        self.timer = None
+        self.generation = 0  # 每次重新计时递增，已被取代的定时器不再执行
+        self.first_at = None
+        self.func = None
+        self.flushes = {'quiet': 0, 'max_wait': 0, 'max_batch_size': 0}
+
+    def trigger(self, func, size=None):
+        '''记录一次触发，func为到期时执行的函数，size为当前待处理的数量'''
+        with self._lock:
+            now = time.monotonic()
+            if self.first_at is None:
+                self.first_at = now
+            self.func = func
+            if self.max_batch_size and size is not None and size >= self.max_batch_size:
+                delay, reason = 0, 'max_batch_size'
+            else:
+                delay, reason = self.quiet_window, 'quiet'
+                if self.max_wait and self.first_at + self.max_wait - now <= delay:
+                    delay, reason = max(0, self.first_at + self.max_wait - now), 'max_wait'
+            if self.timer is not None:
+                self.timer.cancel()
+            self.generation += 1
+            self.timer = threading.Timer(delay, self._fire, (self.generation, reason))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _fire(self, generation, reason):
+        with self._lock:
+            if generation != self.generation:
+                return
+            func, self.func = self.func, None
+            self.first_at = None
+            self.timer = None
+            self.flushes[reason] += 1
+        if func is not None:
+            func()
+
+    def cancel(self):
+        with self._lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.generation += 1
+            self.timer = None
+            self.first_at = None
+            self.func = None
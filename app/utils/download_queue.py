@@ -0,0 +1,142 @@
+import os
+import time
+import uuid
+import queue
+import itertools
+import threading
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class MetadataDownloadQueue(object):
+    '''元数据文件的下载队列：与生成strm的线程池分开，有独立的线程数及带宽限制（KB/s，0表示不限制）。
+    priority_exts中的小文件（nfo、字幕等）优先下载，其余按文件大小从小到大下载；
+    同一目标路径在队列中只保留一个下载，先下载到同目录下的临时文件，完成后再重命名为目标文件。
+    队列中的下载达到max_pending个时，submit等待，直到有下载完成。
+    '''
+
+    def __init__(self, storage_client, max_workers=2, max_bandwidth=0, priority_exts=None, max_pending=1000):
+        self.storage_client = storage_client
+        self.max_workers = max(1, max_workers)
+        self.max_bandwidth = max(0, max_bandwidth) * 1024
+        self.priority_exts = set(priority_exts or [])
+        self.max_pending = max(1, max_pending)
+        self.queue = queue.PriorityQueue()
+        self.pending = {}  # 目标路径 -> 入队序号，被取消或重复入队时旧的任务不再执行
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self.unfinished = 0
+        self.workers = []
+        self._tokens = 0.0
+        self._tokens_at = time.monotonic()
+        self.queued = 0
+        self.deduplicated = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.downloaded_bytes = 0
+
+    def priority(self, dest, size):
+        file_extension = os.path.splitext(dest)[1].lower()
+        return (0 if file_extension in self.priority_exts else 1, size or 0)
+
+    def submit(self, src, dest, size=None):
+        '''加入下载队列，目标路径已在队列中时返回False'''
+        with self._lock:
+            if dest in self.pending:
+                self.deduplicated += 1
+                return False
+            self._ensure_workers()
+            self._not_full.wait_for(lambda: self.unfinished < self.max_pending)
+            if dest in self.pending:
+                self.deduplicated += 1
+                return False
+            seq = next(self._seq)
+            self.pending[dest] = seq
+            self.unfinished += 1
+            self.queued += 1
+        self.queue.put((self.priority(dest, size), seq, src, dest, size or 0))
+        return True
+
+    def cancel(self, dest):
+        '''取消尚未开始的下载（源文件已被删除时）'''
+        with self._lock:
+            return self.pending.pop(dest, None) is not None
+
+    def _ensure_workers(self):
+        self.workers = [w for w in self.workers if w.is_alive()]
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, name=f'metadata-download-{len(self.workers)}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            _, seq, src, dest, size = self.queue.get()
+            try:
+                with self._lock:
+                    cancelled = self.pending.get(dest) != seq
+                if not cancelled and not os.path.exists(dest):
+                    self._throttle(size)
+                    self.download(src, dest)
+                    with self._lock:
+                        self.downloaded += 1
+                        self.downloaded_bytes += size
+                    logger.info(f"复制文件: {src} -> {dest}")
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"复制文件失败: {src} -> {dest}，{e}")
+            finally:
+                with self._lock:
+                    if self.pending.get(dest) == seq:
+                        self.pending.pop(dest)
+                    self.unfinished -= 1
+                    self._not_full.notify()
+                    if self.unfinished == 0:
+                        self._idle.notify_all()
+                self.queue.task_done()
+
+    def _throttle(self, size):
+        '''令牌桶：按文件大小预先扣除令牌，不足时等待，单个文件可超出桶容量（欠账在之后偿还）'''
+        if not self.max_bandwidth or not size:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_bandwidth, self._tokens + (now - self._tokens_at) * self.max_bandwidth)
+            self._tokens_at = now
+            self._tokens -= size
+            wait = -self._tokens / self.max_bandwidth if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def download(self, src, dest):
+        directory, name = os.path.split(dest)
+        os.makedirs(directory, exist_ok=True)
+        temp_path = os.path.join(directory, f'.{name}.{uuid.uuid4().hex[:8]}.part')
+        try:
+            self.storage_client.download(src, temp_path)
+            os.replace(temp_path, dest)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def join(self, timeout=None):
+        '''等待队列中的下载全部完成，超时返回False'''
+        with self._idle:
+            return self._idle.wait_for(lambda: self.unfinished == 0, timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self.unfinished,
+                'queued': self.queued,
+                'deduplicated': self.deduplicated,
+                'downloaded': self.downloaded,
+                'failed': self.failed,
+                'downloaded_bytes': self.downloaded_bytes,
+                'workers': self.max_workers,
+                'max_bandwidth': self.max_bandwidth // 1024,
+            }
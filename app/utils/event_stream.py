@@ -0,0 +1,142 @@
+import os
+import socket
+from redis.exceptions import ResponseError
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class FileChangeStream(object):
+    '''文件变更事件的redis stream：webhook只负责追加事件（XADD），由celery worker通过消费者组读取并处理。
+    事件处理完成后才确认（XACK）并从stream中删除，worker中途退出时未确认的事件保留在消费者组的待确认列表中，
+    闲置超过claim_idle秒后由其他worker认领（XAUTOCLAIM）重新处理，即“至少一次”投递；
+    投递超过max_deliveries次仍未确认的事件、以及处理失败的单个事件视为无法处理，记录日志后移入死信stream。
+    '''
+
+    KEY = 'filechange:stream'
+    GROUP = 'filechange-workers'
+    TRIGGER_KEY = 'filechange:stream:trigger'
+    DEAD_LETTER_KEY = 'filechange:stream:dead'  # 无法处理的事件，保留最近的max_len条以便排查
+
+    def __init__(self, redis, max_len=100000, batch_size=1000, claim_idle=600, max_deliveries=5):
+        self.redis = redis
+        self.max_len = max(1, max_len)
+        self.batch_size = max(1, batch_size)
+        self.claim_idle = max(1, claim_idle)
+        self.max_deliveries = max(1, max_deliveries)
+        self._group_ready = False
+
+    @staticmethod
+    def consumer_name():
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            self.redis.xgroup_create(self.KEY, self.GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_ready = True
+
+    def append(self, events):
+        '''追加事件，events为dict的列表，返回追加的条数'''
+        if not events:
+            return 0
+        self.ensure_group()
+        pipe = self.redis.pipeline(transaction=False)
+        for event in events:
+            # 近似裁剪，仅在积压远超max_len时防止stream无限增长；已确认的事件在确认时即删除
+            pipe.xadd(self.KEY, event, maxlen=self.max_len, approximate=True)
+        pipe.execute()
+        return len(events)
+
+    def schedule_once(self, delay):
+        '''delay秒内只允许调度一次处理任务，返回本次是否需要调度'''
+        return bool(self.redis.set(self.TRIGGER_KEY, 1, nx=True, ex=max(1, int(delay))))
+
+    def claim_stale(self, consumer):
+        '''认领其他worker闲置超过claim_idle秒未确认的事件，丢弃投递次数过多的事件'''
+        self.ensure_group()
+        entries = []
+        start_id = '0-0'
+        while len(entries) < self.batch_size:
+            result = self.redis.xautoclaim(
+                self.KEY,
+                self.GROUP,
+                consumer,
+                min_idle_time=self.claim_idle * 1000,
+                start_id=start_id,
+                count=self.batch_size - len(entries),
+            )
+            start_id, claimed = result[0], result[1]
+            entries.extend(e for e in claimed if e[1] is not None)
+            if start_id in ('0-0', b'0-0'):
+                break
+        return self._drop_undeliverable(consumer, entries)
+
+    def claim_own_pending(self, consumer):
+        '''重新获取本consumer已读取但未确认的事件（处理失败后celery在同一进程中重试时），保证其先于新事件处理'''
+        self.ensure_group()
+        pending = self.redis.xpending_range(self.KEY, self.GROUP, '-', '+', self.batch_size, consumername=consumer)
+        if not pending:
+            return []
+        # XCLAIM给自己，使投递次数加一，用于丢弃反复处理失败的事件
+        entries = self.redis.xclaim(
+            self.KEY, self.GROUP, consumer, min_idle_time=0, message_ids=[p['message_id'] for p in pending]
+        )
+        return self._drop_undeliverable(consumer, [e for e in entries if e[1] is not None])
+
+    def _drop_undeliverable(self, consumer, entries):
+        if not entries:
+            return entries
+        pending = self.redis.xpending_range(
+            self.KEY, self.GROUP, min=entries[0][0], max=entries[-1][0], count=len(entries), consumername=consumer
+        )
+        deliveries = {p['message_id']: p['times_delivered'] for p in pending}
+        dropped = [e for e in entries if deliveries.get(e[0], 0) > self.max_deliveries]
+        if dropped:
+            self.dead_letter(dropped, f"已投递{self.max_deliveries}次仍未处理成功")
+            dropped_ids = {e[0] for e in dropped}
+            entries = [e for e in entries if e[0] not in dropped_ids]
+        return entries
+
+    def read(self, consumer):
+        '''读取最多batch_size条新事件，返回[(id, 事件)]'''
+        self.ensure_group()
+        result = self.redis.xreadgroup(self.GROUP, consumer, {self.KEY: '>'}, count=self.batch_size)
+        return [entry for _, entries in result or [] for entry in entries]
+
+    def ack(self, ids):
+        if not ids:
+            return 0
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xack(self.KEY, self.GROUP, *ids)
+        pipe.xdel(self.KEY, *ids)
+        return pipe.execute()[0]
+
+    def dead_letter(self, entries, reason):
+        '''将无法处理的事件移入死信stream并确认'''
+        if not entries:
+            return 0
+        logger.error(f"以下文件变更事件{reason}，移入死信：{[e[1] for e in entries]}")
+        pipe = self.redis.pipeline(transaction=False)
+        for entry_id, event in entries:
+            pipe.xadd(
+                self.DEAD_LETTER_KEY, dict(event, id=entry_id, reason=reason), maxlen=self.max_len, approximate=True
+            )
+        pipe.execute()
+        return self.ack([entry_id for entry_id, _ in entries])
+
+    def stats(self):
+        self.ensure_group()
+        groups = {g['name']: g for g in self.redis.xinfo_groups(self.KEY)}
+        group = groups.get(self.GROUP, {})
+        return {
+            'length': self.redis.xlen(self.KEY),
+            'pending': group.get('pending', 0),
+            'lag': group.get('lag'),
+            'consumers': group.get('consumers', 0),
+            'dead_letters': self.redis.xlen(self.DEAD_LETTER_KEY),
+        }
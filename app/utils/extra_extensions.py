@@ -1,21 +1,42 @@
 from clouddrive import CloudDriveClient, CloudDriveFileSystem
 from celery import Celery
 from alist import AlistClient, AlistFileSystem
-from threading import Timer
+import functools
+import itertools
+import threading
+import hashlib
+from collections import defaultdict
 import time
 import os
 import json
 import urllib3
+import socket
 from .logger import getLogger
+from .snapshot import DirectorySnapshot
+from .adaptive_polling import AdaptivePolling
+from .checkpoint import ScanCheckpoint
+from .scan_lock import ScanLock
+from .rate_control import AdaptiveRateController
+from .attr_cache import AttrCache
+from .change_pool import ChangePool
+from .path_trie import PathTrie
+from .debouncer import Debouncer
+from .event_stream import FileChangeStream
 
 logger = getLogger(__name__)
 
 
 class FlaskStorageClientWrapper(object):
-    def __init__(self, app=None):
+    STATS_KEY = 'ratecontrol:storage'
+    STATS_PUBLISH_INTERVAL = 10
+    CACHE_INVALIDATIONS_KEY = 'storagecache:invalidations'
+    # 下载元数据文件在整个传输过程中占用连接，不占用listing的并发配额，由下载队列自身的线程数限制
+    UNCONTROLLED_METHODS = {'download'}
+
+    def __init__(self, app=None, db=None):
         self.app = app
         if app is not None:
-            self.init_app(app)
+            self.init_app(app, db)
 
     def connect_fs(self):
         if self.provider == 'clouddrive2':
@@ -28,66 +49,474 @@ class FlaskStorageClientWrapper(object):
             raise NotImplementedError(f"The function connect_fs not implemented for provider {self.provider}")
         logger.info(f"已连接到{self.provider}[{self.host}]！")
 
-    def init_app(self, app):
+    def init_app(self, app, db=None):
         self.provider = app.config['STORAGE_PROVIDER']
         self.host = app.config['STORAGE_HOST']
         self.username = app.config['STORAGE_USERNAME']
         self.password = app.config['STORAGE_PASSWORD']
+        self.max_concurrent_listings = max(1, int(app.config['STORAGE_MAX_CONCURRENT_LISTINGS']))
+        self.max_retries = max(0, int(app.config['STORAGE_RATE_CONTROL_MAX_RETRIES']))
+        self.rate_controller = None
+        if app.config['STORAGE_RATE_CONTROL_ENABLED']:
+            self.rate_controller = AdaptiveRateController(
+                self.provider,
+                initial_concurrency=self.max_concurrent_listings,
+                min_concurrency=app.config['STORAGE_RATE_CONTROL_MIN_CONCURRENCY'],
+                max_concurrency=app.config['STORAGE_RATE_CONTROL_MAX_CONCURRENCY'],
+                min_rate=app.config['STORAGE_RATE_CONTROL_MIN_RATE'],
+                max_rate=app.config['STORAGE_RATE_CONTROL_MAX_RATE'],
+                increase_step=app.config['STORAGE_RATE_CONTROL_INCREASE_STEP'],
+                decrease_factor=app.config['STORAGE_RATE_CONTROL_DECREASE_FACTOR'],
+                cooldown=app.config['STORAGE_RATE_CONTROL_COOLDOWN'],
+                max_wait=app.config['STORAGE_RATE_CONTROL_MAX_WAIT'],
+                throttle_keywords=app.config['STORAGE_RATE_CONTROL_THROTTLE_KEYWORDS'],
+            )
+        # attr/listdir_attr/exists的结果缓存，失效的路径经redis同步到各进程
+        self.cache = None
+        if app.config['STORAGE_CACHE_ENABLED']:
+            self.cache = AttrCache(app.config['STORAGE_CACHE_TTLS'], app.config['STORAGE_CACHE_MAX_ENTRIES'])
+        self.cache_sync_interval = app.config['STORAGE_CACHE_SYNC_INTERVAL']
+        self.cache_synced_at = time.time()
+        # 各进程（web/调度器、celery worker）的限流状态定期发布到redis，便于统一查看
+        self.db = db
+        self.stats_published_at = 0
         self.connect_fs()
         if not hasattr(app, 'extensions'):
             app.extensions = {}
         app.extensions['storage_client'] = self
 
-    def attr(self, *args, **kwargs):
+    def _call(self, method, *args, **kwargs):
+        '''所有网盘接口调用的入口：经过自适应限流，遇到限流/超时按退避时间重试，连接断开时重连；
+        UNCONTROLLED_METHODS中的调用不经过限流，也不影响限流器的并发及速率
+        '''
+        controller = None if method in self.UNCONTROLLED_METHODS else self.rate_controller
+        attempt = 0
+        while True:
+            try:
+                if controller is None:
+                    return getattr(self.fs, method)(*args, **kwargs)
+                with controller.slot():
+                    start = time.monotonic()
+                    result = getattr(self.fs, method)(*args, **kwargs)
+                    controller.on_success(time.monotonic() - start)
+                    return result
+            except Exception as e:
+                if "Failed to connect to remote host" in str(e) and attempt == 0:
+                    self.connect_fs()
+                elif controller is not None and controller.is_throttle_error(e) and attempt < self.max_retries:
+                    controller.on_throttle(e)
+                    time.sleep(controller.backoff(attempt))
+                elif isinstance(e, OSError):
+                    raise OSError(e)
+                else:
+                    raise
+                attempt += 1
+            finally:
+                self.publish_stats()
+
+    def stats(self):
+        '''当前进程的限流状态及缓存命中情况'''
+        if self.rate_controller is None:
+            stats = {'name': self.provider, 'enabled': False}
+        else:
+            stats = dict(self.rate_controller.stats(), enabled=True, pid=os.getpid())
+        stats['cache'] = self.cache.stats() if self.cache is not None else None
+        return stats
+
+    def publish_stats(self, force=False):
+        if self.db is None or self.rate_controller is None:
+            return
+        now = time.time()
+        if not force and now - self.stats_published_at < self.STATS_PUBLISH_INTERVAL:
+            return
+        self.stats_published_at = now
         try:
-            return self.fs.attr(*args, **kwargs)
-        except OSError as e:
-            if "Failed to connect to remote host" in str(e):
-                self.connect_fs()
-                return self.fs.attr(*args, **kwargs)
-            else:
-                raise OSError(e)
+            pipe = self.db.pipeline(transaction=False)
+            field = f"{socket.gethostname()}:{os.getpid()}"
+            pipe.hset(self.STATS_KEY, field, json.dumps(dict(self.stats(), published_at=now)))
+            pipe.expire(self.STATS_KEY, self.STATS_PUBLISH_INTERVAL * 10)
+            pipe.execute()
+        except Exception as e:
+            logger.debug(f"发布限流状态失败：{e}")
+
+    def published_stats(self):
+        '''所有进程发布到redis的限流状态'''
+        if self.db is None:
+            return {}
+        self.publish_stats(force=True)
+        return {k: json.loads(v) for k, v in self.db.hgetall(self.STATS_KEY).items()}
+
+    def _cached_call(self, method, path, refresh=False, **kwargs):
+        '''经过缓存调用attr/listdir_attr/exists；refresh时不读取缓存，但用请求结果刷新缓存'''
+        if self.cache is None or kwargs or not self.cache.enabled_for(method):
+            return self._call(method, path, **kwargs)
+        self.sync_cache_invalidations()
+        if not refresh:
+            hit, value = self.cache.get(method, path)
+            if hit:
+                return list(value) if method == 'listdir_attr' else value
+        generation = self.cache.generation
+        value = self._call(method, path)
+        if method == 'listdir_attr':
+            value = list(value)
+            # listing中已包含子文件（夹）的属性
+            for a in value:
+                self.cache.put('attr', a['path'], a, generation)
+                self.cache.put('exists', a['path'], True, generation)
+            self.cache.put(method, path, value, generation)
+            return list(value)
+        self.cache.put(method, path, value, generation)
+        if method == 'attr':
+            self.cache.put('exists', path, True, generation)
+        return value
+
+    def invalidate_cache(self, path, recursive=False):
+        '''网盘中的文件（夹）变更后，使其路径及祖先目录的缓存失效，并经redis通知其他进程'''
+        return self.invalidate_cache_many([(path, recursive)])
+
+    def invalidate_cache_many(self, items):
+        '''批量失效[(路径, recursive)]，并在一次redis往返中通知其他进程'''
+        if self.cache is None or not items:
+            return 0
+        items = list(dict.fromkeys((path, bool(recursive)) for path, recursive in items))
+        count = self.cache.invalidate_many(items)
+        if self.db is not None:
+            now = time.time()
+            retention = max(self.cache.ttls.values()) + self.cache_sync_interval * 2
+            try:
+                pipe = self.db.pipeline(transaction=False)
+                pipe.zadd(
+                    self.CACHE_INVALIDATIONS_KEY,
+                    {json.dumps([path, recursive], ensure_ascii=False): now for path, recursive in items},
+                )
+                pipe.zremrangebyscore(self.CACHE_INVALIDATIONS_KEY, '-inf', now - retention)
+                pipe.execute()
+            except Exception as e:
+                logger.debug(f"发布缓存失效路径失败：{e}")
+        return count
 
-    def is_dir(self, *args, **kwargs):
+    def sync_cache_invalidations(self):
+        '''每隔sync_interval读取其他进程（如接收文件变更通知的web进程）发布的失效路径'''
+        if self.db is None:
+            return
+        now = time.time()
+        if now - self.cache_synced_at < self.cache_sync_interval:
+            return
+        since, self.cache_synced_at = self.cache_synced_at, now
+        try:
+            # 向前多读取一个间隔，容忍各主机间的时钟偏差，重复失效没有副作用
+            items = self.db.zrangebyscore(self.CACHE_INVALIDATIONS_KEY, since - self.cache_sync_interval, '+inf')
+        except Exception as e:
+            logger.debug(f"读取缓存失效路径失败：{e}")
+            return
+        if items:
+            self.cache.invalidate_many([json.loads(item) for item in items])
+
+    def attr(self, path, refresh=False, **kwargs):
+        return self._cached_call('attr', path, refresh, **kwargs)
+
+    def attr_is_dir(self, attr):
+        '''根据attr/listdir_attr返回的属性判断是否为目录'''
         if self.provider == 'clouddrive2':
-            return self.attr(*args, **kwargs)['isDirectory']
+            return attr['isDirectory']
         elif self.provider == 'alist':
-            return self.attr(*args, **kwargs)['is_dir']
+            return attr['is_dir']
         else:
-            raise NotImplementedError(f"The function is_dir not implemented for provider {self.provider}")
+            raise NotImplementedError(f"The function attr_is_dir not implemented for provider {self.provider}")
+
+    def is_dir(self, *args, **kwargs):
+        return self.attr_is_dir(self.attr(*args, **kwargs))
+
+    @staticmethod
+    def compact_attr(attr):
+        '''仅保留遍历所需的属性，用于保存检查点'''
+        return {k: attr[k] for k in ('path', 'name', 'mtime', 'isDirectory', 'is_dir') if k in attr}
+
+    @staticmethod
+    def attr_mtime(attr):
+        return str(attr['mtime'])
 
     def get_mtime(self, *args, **kwargs):
-        return str(self.attr(*args, **kwargs)['mtime'])
+        return self.attr_mtime(self.attr(*args, **kwargs))
 
-    def walk_attr(self, *args, **kwargs):
+    def walk_attr(self, top, topdown=True, onerror=None, refresh=False):
+        '''基于listdir_attr的目录树遍历，每次listdir均经过限流；topdown时可修改dirs以跳过子目录'''
         try:
-            return self.fs.walk_attr(*args, **kwargs)
+            subs = self.listdir_attr(top, refresh=refresh)
         except OSError as e:
-            if "Failed to connect to remote host" in str(e):
-                self.connect_fs()
-                return self.fs.walk_attr(*args, **kwargs)
-            else:
-                raise OSError(e)
+            if onerror is not None:
+                onerror(e)
+                return
+            raise
+        dirs = [a for a in subs if self.attr_is_dir(a)]
+        files = [a for a in subs if not self.attr_is_dir(a)]
+        if topdown:
+            yield top, dirs, files
+        for d in dirs:
+            yield from self.walk_attr(d['path'], topdown=topdown, onerror=onerror, refresh=refresh)
+        if not topdown:
+            yield top, dirs, files
+
+    def listdir_attr(self, path, refresh=False, **kwargs):
+        return self._cached_call('listdir_attr', path, refresh, **kwargs)
+
+    def exists(self, path, refresh=False, **kwargs):
+        return self._cached_call('exists', path, refresh, **kwargs)
+
+    def download(self, *args, **kwargs):
+        return self._call('download', *args, **kwargs)
+
+
+class FlaskMtimeStoreWrapper(object):
+    '''目录mtime的redis存储，按batch_size分批使用pipeline读写，并按线程统计redis往返次数；
+    目录的mtime（保留网盘返回的完整精度）保存在其父目录对应的哈希表中：{KEY_PREFIX}:{hash(父目录)} 字段为目录名，
+    {KEY_PREFIX}:{hash(目录)}:dirs 集合记录该目录下含有已保存mtime的子孙的子目录名（与子目录自身是否保存了mtime无关），
+    因此清空或枚举某个目录的子树只需逐层读取子树中的哈希表及集合，单独删除某个目录的mtime也不会使其子孙无法访问。
+    '''
+
+    KEY_PREFIX = 'mtime'
+    LAYOUT_KEY = 'mtime:layout'
+    LAYOUT_VERSION = '2'
+    LAYOUT_LOCK_KEY = 'mtime:layout:lock'
+    SCAN_LOCK_PREFIX = 'scanlock'
+    SCAN_LOCK_TTL = 300  # 由后台线程定期续期，持有锁的进程退出后最多该时间（秒）自动释放
+
+    def __init__(self, app=None, db=None):
+        self.app = app
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.db = db
+        self.batch_size = max(1, int(app.config['REDIS_BATCH_SIZE']))
+        self.snapshot_enabled = app.config['FOLDER_MONITOR_SNAPSHOT_ENABLED']
+        self.prune_unchanged_subtrees = app.config['FOLDER_MONITOR_PRUNE_UNCHANGED_SUBTREES']
+        self.adaptive_polling_enabled = app.config['FOLDER_MONITOR_ADAPTIVE_POLLING_ENABLED']
+        self.min_staleness = app.config['FOLDER_MONITOR_MIN_STALENESS']
+        self.max_staleness = app.config['FOLDER_MONITOR_MAX_STALENESS']
+        self.checkpoint_enabled = app.config['FOLDER_MONITOR_CHECKPOINT_ENABLED']
+        self.checkpoint_interval = app.config['FOLDER_MONITOR_CHECKPOINT_INTERVAL']
+        self.checkpoint_max_age = app.config['FOLDER_MONITOR_CHECKPOINT_MAX_AGE']
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['mtime_store'] = self
 
-    def listdir_attr(self, *args, **kwargs):
-        try:
-            return self.fs.listdir_attr(*args, **kwargs)
-        except OSError as e:
-            if "Failed to connect to remote host" in str(e):
-                self.connect_fs()
-                return self.fs.listdir_attr(*args, **kwargs)
-            else:
-                raise OSError(e)
+    @property
+    def round_trips(self):
+        return getattr(self._local, 'round_trips', 0)
 
-    def exists(self, *args, **kwargs):
-        try:
-            return self.fs.exists(*args, **kwargs)
-        except OSError as e:
-            if "Failed to connect to remote host" in str(e):
-                self.connect_fs()
-                return self.fs.exists(*args, **kwargs)
-            else:
-                raise OSError(e)
+    def reset_round_trips(self):
+        self._local.round_trips = 0
+
+    def count_round_trip(self):
+        self._local.round_trips = self.round_trips + 1
+
+    def _chunks(self, items):
+        for i in range(0, len(items), self.batch_size):
+            yield items[i : i + self.batch_size]
+
+    @classmethod
+    def bucket_key(cls, parent):
+        '''目录parent下所有子目录的mtime所在的哈希表'''
+        return f"{cls.KEY_PREFIX}:{hashlib.blake2b(parent.encode('utf-8'), digest_size=12).hexdigest()}"
+
+    @classmethod
+    def dirs_key(cls, parent):
+        '''目录parent下含有已保存mtime的子孙的子目录名集合'''
+        return f"{cls.bucket_key(parent)}:dirs"
+
+    @classmethod
+    def locate(cls, path):
+        '''路径 -> (哈希表, 字段)'''
+        path = path.rstrip('/') or '/'
+        parent, name = os.path.split(path)
+        return cls.bucket_key(parent), name
+
+    @staticmethod
+    def normalize_mtime(mtime):
+        return str(mtime)
+
+    def get(self, path):
+        return self.get_many([path])[0]
+
+    def set(self, path, mtime):
+        self.set_many({path: mtime})
+
+    def delete(self, path):
+        self.delete_many([path])
+
+    def get_many(self, paths):
+        paths = list(paths)
+        values = []
+        for chunk in self._chunks(paths):
+            self.count_round_trip()
+            pipe = self.db.pipeline(transaction=False)
+            for path in chunk:
+                pipe.hget(*self.locate(path))
+            values.extend(pipe.execute())
+        return values
+
+    def set_many(self, path2mtime):
+        items = list(path2mtime.items())
+        for chunk in self._chunks(items):
+            buckets = defaultdict(dict)
+            ancestors = defaultdict(set)
+            for path, mtime in chunk:
+                key, name = self.locate(path)
+                buckets[key][name] = self.normalize_mtime(mtime)
+                # 将哈希表所在目录逐级登记到祖先目录的子目录集合中，直到已登记的祖先
+                parent = os.path.dirname(path.rstrip('/') or '/')
+                while parent != '/':
+                    grandparent, name = os.path.split(parent)
+                    if name in ancestors[grandparent]:
+                        break
+                    ancestors[grandparent].add(name)
+                    parent = grandparent
+            self.count_round_trip()
+            pipe = self.db.pipeline(transaction=False)
+            for key, mapping in buckets.items():
+                pipe.hset(key, mapping=mapping)
+            for parent, names in ancestors.items():
+                pipe.sadd(self.dirs_key(parent), *names)
+            pipe.execute()
+
+    def delete_many(self, paths):
+        paths = list(paths)
+        for chunk in self._chunks(paths):
+            buckets = defaultdict(list)
+            for path in chunk:
+                key, name = self.locate(path)
+                buckets[key].append(name)
+            self.count_round_trip()
+            pipe = self.db.pipeline(transaction=False)
+            for key, names in buckets.items():
+                pipe.hdel(key, *names)
+            pipe.execute()
+
+    def _iter_buckets(self, folder):
+        '''逐层产出folder及其子孙目录的(目录, {子目录名: mtime})，按子目录集合下探，不依赖中间目录是否保存了mtime'''
+        level = [folder]
+        while level:
+            next_level = []
+            for chunk in self._chunks(level):
+                self.count_round_trip()
+                pipe = self.db.pipeline(transaction=False)
+                for path in chunk:
+                    pipe.hgetall(self.bucket_key(path))
+                    pipe.smembers(self.dirs_key(path))
+                results = pipe.execute()
+                for path, children, dirs in zip(chunk, results[::2], results[1::2]):
+                    yield path, children
+                    next_level.extend(os.path.join(path, name) for name in dict.fromkeys([*children, *dirs]))
+            level = next_level
+
+    def iter_subtree(self, folder):
+        '''逐层遍历folder及其子孙目录中已保存的mtime，产出(路径, mtime)；耗时与子树大小成正比'''
+        folder = folder.rstrip('/') or '/'
+        mtime = self.get(folder)
+        if mtime is not None:
+            yield folder, mtime
+        for path, children in self._iter_buckets(folder):
+            for name, mtime in children.items():
+                yield os.path.join(path, name), mtime
+
+    def clear_subtree(self, folder):
+        '''删除folder及其子孙目录的mtime（包括中间目录已被单独删除而遗留的子孙），返回子树中的目录数量'''
+        folder = folder.rstrip('/') or '/'
+        paths = [path for path, _ in self._iter_buckets(folder)]
+        for chunk in self._chunks(paths):
+            self.count_round_trip()
+            self.db.delete(*[self.bucket_key(p) for p in chunk], *[self.dirs_key(p) for p in chunk])
+        self.delete(folder)
+        if folder != '/':
+            parent, name = os.path.split(folder)
+            self.db.srem(self.dirs_key(parent), name)
+        return len(paths)
+
+    def move_subtree(self, src, dest):
+        '''目录src被移动为dest后，将src及其子孙目录的mtime移动到dest下，返回移动的数量'''
+        src = src.rstrip('/') or '/'
+        dest = dest.rstrip('/') or '/'
+        moved = {dest + path[len(src) :]: mtime for path, mtime in self.iter_subtree(src)}
+        self.clear_subtree(src)
+        self.set_many(moved)
+        return len(moved)
+
+    def is_layout_migrated(self):
+        return self.db.get(self.LAYOUT_KEY) == self.LAYOUT_VERSION
+
+    def migrate_legacy_layout(self):
+        '''一次性迁移：将旧版"一个路径一个字符串key"的mtime迁移到按父目录分桶的哈希表，返回迁移的数量；
+        持有锁进行迁移，多个进程同时启动时只有一个进程迁移
+        '''
+        if self.is_layout_migrated():
+            return 0
+        with self.db.lock(self.LAYOUT_LOCK_KEY, timeout=600, blocking_timeout=600):
+            if self.is_layout_migrated():
+                return 0
+            migrated = 0
+            legacy_keys = []
+            for key in self.db.scan_iter(match='/*', count=self.batch_size):
+                legacy_keys.append(key)
+                if len(legacy_keys) >= self.batch_size:
+                    migrated += self._migrate_legacy_keys(legacy_keys)
+                    legacy_keys.clear()
+            migrated += self._migrate_legacy_keys(legacy_keys)
+            self.db.set(self.LAYOUT_KEY, self.LAYOUT_VERSION)
+        return migrated
+
+    def wait_layout_migrated(self, timeout=600, interval=1):
+        '''等待web进程完成mtime存储格式的迁移，超时返回False'''
+        deadline = time.time() + timeout
+        while not self.is_layout_migrated():
+            if time.time() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+    def _migrate_legacy_keys(self, keys):
+        if not keys:
+            return 0
+        pipe = self.db.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+            pipe.get(key)
+        results = pipe.execute()
+        path2mtime = {}
+        for key, key_type, value in zip(keys, results[::2], results[1::2]):
+            if key_type != 'string' or value is None:
+                continue
+            path2mtime[key] = self.normalize_mtime(value)
+        self.set_many(path2mtime)
+        if path2mtime:
+            self.db.delete(*path2mtime.keys())
+        return len(path2mtime)
+
+    def snapshot(self, root, storage_client):
+        '''获取监控目录root的目录快照，未启用快照时返回None'''
+        if not self.snapshot_enabled:
+            return None
+        return DirectorySnapshot(self, root, storage_client)
+
+    def adaptive_polling(self, root, storage_client):
+        '''获取监控目录root的自适应遍历状态，未启用时返回None'''
+        if not self.adaptive_polling_enabled:
+            return None
+        return AdaptivePolling(self, root, storage_client, self.min_staleness, self.max_staleness)
+
+    def scan_lock(self, folder):
+        '''目录遍历的锁，同一目录同时只允许一个遍历任务（定时任务、celery任务等）'''
+        redis_lock = self.db.lock(
+            f"{self.SCAN_LOCK_PREFIX}:{folder}", timeout=self.SCAN_LOCK_TTL, blocking=False, thread_local=False
+        )
+        return ScanLock(redis_lock, folder, self.SCAN_LOCK_TTL)
+
+    def checkpoint(self, folder, mode):
+        '''获取目录folder在遍历模式mode下的检查点，未启用时返回None'''
+        if not self.checkpoint_enabled:
+            return None
+        return ScanCheckpoint(self, folder, mode, self.checkpoint_interval, self.checkpoint_max_age)
 
 
 class FlaskCeleryWrapper(object):
@@ -134,40 +563,147 @@ class FlaskFileChangeHandlerWrapper(object):
         if app is not None:
             self.init_app(app)
 
-    def init_app(self, app):
+    def init_app(self, app, redis_db=None):
         self.init_handler(app)
+        self.init_stream(app, redis_db)
         if not hasattr(app, 'extensions'):
             app.extensions = {}
         app.extensions['filechangehandler'] = self
 
     def init_handler(self, app):
         self.wait_time = int(app.config['FC_HANDLER_TIMER_INTERVAL'])  # 等待时间（秒）
-        self.dest_filepool = []  # 用于存储路径信息列表
-        self.src_filepool = []
-        self.last_event_time = 0  # 上一次事件的时间戳
-        self.dest_timer = None  # 定时器
-        self.src_timer = None
-
         # 配置可处理的文件后缀和关键词
         self.allowed_extensions = app.config['FC_HANDLER_ALLOWED_EXTS']
         self.allowed_keywords = app.config['FC_HANDLER_ALLOWED_PATH_KEYWORDS']
+        # 待处理的路径：去重并合并已有祖先目录待处理的路径；新增的文件较多时合并为父目录，删除的路径不合并（父目录并未被删除）
+        self.dest_filepool = ChangePool(
+            app.config['FC_HANDLER_COLLAPSE_SIBLINGS_THRESHOLD'],
+            can_collapse=lambda p: any(kw in p for kw in self.allowed_keywords),
+        )
+        self.src_filepool = ChangePool()
+        self.move_pool = {}  # 移动/重命名的(原路径, 新路径)，按加入顺序去重
+        self.last_event_time = 0  # 上一次事件的时间戳
+        # 收到变更后等待wait_time秒没有新的变更再处理，但距本批第一个变更最多等待max_wait秒，待处理的路径达到max_batch_size时立即处理
+        self.max_wait = int(app.config['FC_HANDLER_MAX_WAIT'])
+        self.max_batch_size = int(app.config['FC_HANDLER_MAX_BATCH_SIZE'])
+        self.dest_timer = Debouncer(self.wait_time, self.max_wait, self.max_batch_size)
+        self.src_timer = Debouncer(self.wait_time, self.max_wait, self.max_batch_size)
+        self.move_timer = Debouncer(self.wait_time, self.max_wait, self.max_batch_size)
+
         self.sync_other_device_enabled = app.config['FC_HANDLER_SYNC_OTHER_DEVICE_ENABLED']
         if self.sync_other_device_enabled:
             self.sync_other_device_url = app.config['FC_HANDLER_SYNC_OTHER_DEVICE_URL']
             self.sync_other_device_headers = {"Content-Type": "application/json; charset=UTF-8"}
             self.http = urllib3.PoolManager()
 
+    def init_stream(self, app, redis_db):
+        # 启用时webhook只将事件追加到redis stream，由celery worker合并后处理，重启后未处理的事件不丢失
+        self.stream = None
+        if app.config['FC_HANDLER_STREAM_ENABLED'] and redis_db is not None:
+            self.stream = FileChangeStream(
+                redis_db,
+                max_len=app.config['FC_HANDLER_STREAM_MAX_LEN'],
+                batch_size=self.max_batch_size or 1000,
+                claim_idle=app.config['FC_HANDLER_STREAM_CLAIM_IDLE'],
+                max_deliveries=app.config['FC_HANDLER_STREAM_MAX_DELIVERIES'],
+            )
+        self.stream_recover_interval = app.config['FC_HANDLER_STREAM_RECOVER_INTERVAL']
+
+    def _classify_event(self, event):
+        '''返回(变更类型, 涉及的路径)，不在处理范围内的事件返回(None, [])'''
+        action_cn, src_path, dest_path = event.get('action'), event.get('src', ''), event.get('dest', '')
+        if action_cn in ("移动", "重命名"):
+            src_valid, dest_valid = self._is_valid_file(src_path), self._is_valid_file(dest_path)
+            if src_valid and dest_valid:
+                return 'move', [src_path, dest_path]
+            # 只有一侧在处理范围内：移出范围视为删除原路径，移入范围视为创建新路径
+            if src_valid:
+                return 'delete', [src_path]
+            if dest_valid:
+                return 'create', [dest_path]
+        elif action_cn in ("创建", "删除") and self._is_valid_file(src_path):
+            return ('create' if action_cn == "创建" else 'delete'), [src_path]
+        return None, []
+
+    @staticmethod
+    def _overlaps(trie, path):
+        '''trie中有path本身、其祖先或子孙'''
+        return trie.longest_prefix(path)[0] is not None or next(trie.iter_under(path), None) is not None
+
+    def segment_events(self, entries):
+        '''将从stream读取的[(id, 事件)]按顺序切分为若干段并在段内合并：同一段内同一路径（及其祖先、子孙）只涉及一种变更，
+        各段依次处理，从而保持同一路径上变更的先后顺序（如删除后重新创建、移动后再修改）。
+        返回段的列表，每段为dict：ids（段内所有事件的id）、creates、deletes、moves、
+        create_paths（事件id -> 新增的路径，用于找出处理失败的事件）
+        '''
+        segments = []
+        segment = None
+        for entry_id, event in entries:
+            kind, paths = self._classify_event(event)
+            if segment is None or any(
+                self._overlaps(trie, p) for k, trie in segment['tries'].items() if k != kind for p in paths
+            ):
+                segment = {'ids': [], 'events': [], 'tries': defaultdict(PathTrie)}
+                segments.append(segment)
+            segment['ids'].append(entry_id)
+            if kind is None:
+                continue
+            segment['events'].append((entry_id, kind, paths))
+            for p in paths:
+                segment['tries'][kind].insert(p)
+        return [self._coalesce_segment(segment) for segment in segments]
+
+    def _coalesce_segment(self, segment):
+        dest_pool = ChangePool(
+            self.dest_filepool.collapse_threshold,
+            can_collapse=self.dest_filepool.can_collapse,
+        )
+        src_pool = ChangePool()
+        moves = {}
+        create_paths = {}
+        for entry_id, kind, paths in segment['events']:
+            if kind == 'move':
+                moves[tuple(paths)] = None
+            elif kind == 'create':
+                dest_pool.add(paths[0])
+                create_paths[entry_id] = paths[0]
+            else:
+                src_pool.add(paths[0])
+        dest_paths, dest_events = dest_pool.drain()
+        src_paths, src_events = src_pool.drain()
+        if dest_events + src_events > len(dest_paths) + len(src_paths):
+            logger.info(
+                f"文件变更事件：收到{dest_events + src_events}个新增/删除，合并后处理{len(dest_paths) + len(src_paths)}个路径"
+            )
+        return {
+            'ids': segment['ids'],
+            'creates': dest_paths,
+            'deletes': src_paths,
+            'moves': list(moves),
+            'create_paths': create_paths,
+        }
+
     def reset_dest_timer(self, _func):
-        if self.dest_timer:
-            self.dest_timer.cancel()
-        self.dest_timer = Timer(self.wait_time, self.process_dest_changes, (_func,))
-        self.dest_timer.start()
+        self.dest_timer.trigger(functools.partial(self.process_dest_changes, _func), len(self.dest_filepool))
 
     def reset_src_timer(self, _func):
-        if self.src_timer:
-            self.src_timer.cancel()
-        self.src_timer = Timer(self.wait_time, self.process_src_changes, (_func,))
-        self.src_timer.start()
+        self.src_timer.trigger(functools.partial(self.process_src_changes, _func), len(self.src_filepool))
+
+    def reset_move_timer(self, _func):
+        self.move_timer.trigger(functools.partial(self.process_move_changes, _func), len(self.move_pool))
+
+    def add_move(self, src_path, dest_path, _func, src_func, dest_func):
+        '''两侧都在处理范围内时作为移动处理；移出范围视为删除原路径，移入范围视为创建新路径'''
+        src_valid, dest_valid = self._is_valid_file(src_path), self._is_valid_file(dest_path)
+        if not (src_valid and dest_valid):
+            if src_valid:
+                self.add_change(src_path, _func=src_func, src_file_flag=True)
+            elif dest_valid:
+                self.add_change(dest_path, _func=dest_func)
+            return
+        self.move_pool[(src_path, dest_path)] = None
+        self.reset_move_timer(_func)
+        self.last_event_time = time.time()
 
     def add_change(self, path, _func, src_file_flag=False):
         # 过滤文件后缀
@@ -180,30 +716,46 @@ class FlaskFileChangeHandlerWrapper(object):
         # if dir_path not in self.changedfile_pool:
         # self.changedfile_pool.append(dir_path)
         if src_file_flag:
-            if path not in self.src_filepool:
-                self.src_filepool.append(path)
+            self.src_filepool.add(path)
             self.reset_src_timer(_func)
         else:
-            if path not in self.dest_filepool:
-                self.dest_filepool.append(path)
+            self.dest_filepool.add(path)
             self.reset_dest_timer(_func)
         self.last_event_time = time.time()
 
+    def drain_pool(self, pool, desc):
+        paths, events = pool.drain(self.max_batch_size)
+        if paths and events > len(paths):
+            logger.info(f"{desc}：收到{events}个变更，合并后处理{len(paths)}个路径（吸收{events - len(paths)}个）")
+        return paths
+
     def process_dest_changes(self, _func):
-        if len(self.dest_filepool) == 0:
-            return
+        # 每批最多max_batch_size个路径
+        while True:
+            paths = self.drain_pool(self.dest_filepool, "新增的文件（夹）")
+            if len(paths) == 0:
+                return
 
-        _func(self.dest_filepool)
-        # 清空记录
-        self.dest_filepool.clear()
+            _func(paths)
 
     def process_src_changes(self, _func):
-        if len(self.src_filepool) == 0:
-            return
-
-        _func(self.src_filepool)
-        # 清空记录
-        self.src_filepool.clear()
+        while True:
+            paths = self.drain_pool(self.src_filepool, "删除的文件（夹）")
+            if len(paths) == 0:
+                return
+
+            _func(paths)
+
+    def process_move_changes(self, _func):
+        while True:
+            # 取出记录
+            moves = list(itertools.islice(self.move_pool, self.max_batch_size or None))
+            for move in moves:
+                self.move_pool.pop(move, None)
+            if len(moves) == 0:
+                return
+
+            _func(moves)
 
     def _is_valid_file(self, path):
         """
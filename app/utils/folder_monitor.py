@@ -1,40 +1,40 @@
 import os
 from .pytimeparse import timeparse
-from .others import timestamp_to_datetime, str2bool, read_deepvalue
+from .others import timestamp_to_datetime
 from .logger import getLogger
-from .scanner import PlexScanner, EmbyScanner, EmbyStrmScanner
+from .checkpoint import ScanCheckpoint
+from .scan_lock import ScanLockLost
+from .scanner import scanner_registry
 
 from datetime import datetime
 import functools
+import concurrent.futures
 from collections import defaultdict
 
 logger = getLogger(__name__)
 
 
 class ScanningPool(object):
-    def __init__(self, servers_cfg, storage_client, db, this_logger=logger):
+    def __init__(self, servers_cfg, storage_client, db, this_logger=logger, snapshot=None):
         self.storage_client = storage_client
         self.db = db
+        self.snapshot = snapshot
         self.media_servers_cfg = servers_cfg
         self.pool = []
         self.wait_updating_mtimepaths = defaultdict(list)
         self.mtimepath2mtime = {}
+        self.path_isdir = {}  # 遍历时已知的路径是否为目录，避免再次请求attr
         self.scanners = []
         self.init_scanners()
         self.logger = this_logger
 
     def init_scanners(self):
-        self.scanners.clear()
-        servers = self.media_servers_cfg.keys()
-        if 'plex' in servers and str2bool(read_deepvalue(self.media_servers_cfg, 'plex', 'enabled')):
-            self.scanners.append(PlexScanner(self.media_servers_cfg['plex']))
-        if 'emby' in servers and str2bool(read_deepvalue(self.media_servers_cfg, 'emby', 'enabled')):
-            self.scanners.append(EmbyScanner(self.media_servers_cfg['emby']))
-        if 'embystrm' in servers and str2bool(read_deepvalue(self.media_servers_cfg, 'embystrm', 'enabled')):
-            _scanner = EmbyStrmScanner(self.media_servers_cfg['embystrm'], self.storage_client.fs)
-            self.scanners.append(_scanner)
-
-    def put(self, mtime, mtime_path, sub_folders):
+        # 扫描器在进程内共享，不会每次都重新连接媒体服务器
+        self.scanners = scanner_registry.get_scanners(self.media_servers_cfg, self.storage_client, self.db)
+
+    def put(self, mtime, mtime_path, sub_folders, isdir_map=None):
+        if isdir_map:
+            self.path_isdir.update(isdir_map)
         if type(sub_folders) == list:
             self.pool.extend(sub_folders)
             self.wait_updating_mtimepaths[mtime_path].extend(sub_folders)
@@ -48,6 +48,50 @@ class ScanningPool(object):
             raise TypeError(f"Invalid path type: {type(sub_folders)}")
         self.mtimepath2mtime[mtime_path] = mtime
 
+    def dump_state(self):
+        '''待扫描的内容，用于保存检查点'''
+        return {
+            'pool': self.pool,
+            'wait_updating_mtimepaths': self.wait_updating_mtimepaths,
+            'mtimepath2mtime': self.mtimepath2mtime,
+            'path_isdir': self.path_isdir,
+        }
+
+    def load_state(self, state):
+        '''从检查点恢复待扫描的内容'''
+        self.pool.extend(state['pool'])
+        for mtime_path, sub_folders in state['wait_updating_mtimepaths'].items():
+            self.wait_updating_mtimepaths[mtime_path].extend(sub_folders)
+        self.mtimepath2mtime.update(state['mtimepath2mtime'])
+        self.path_isdir.update(state['path_isdir'])
+
+    def dispatch(self, file_based_queue, path_based_queue, **kwargs):
+        '''各媒体服务器并发扫描，每个服务器在自己的线程中按顺序处理自己的队列，并受该服务器的分发并发上限限制；
+        返回[(扫描器, 路径 -> 是否扫描成功)]。任一扫描器抛出异常时，等待其他扫描器完成后再抛出
+        '''
+
+        def _dispatch(_scanner):
+            _queue = file_based_queue if _scanner.isfile_based_scanning else path_based_queue
+            with _scanner.client.dispatch_slot():
+                self.logger.info(f"Scanning on {_scanner.server_type} media server...")
+                return _scanner.scan_paths(_queue, **kwargs)
+
+        if len(self.scanners) <= 1:
+            return [(_scanner, _dispatch(_scanner)) for _scanner in self.scanners]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.scanners)) as executor:
+            futures = [(_scanner, executor.submit(_dispatch, _scanner)) for _scanner in self.scanners]
+        dispatched = []
+        error = None
+        for _scanner, future in futures:
+            try:
+                dispatched.append((_scanner, future.result()))
+            except Exception as e:
+                self.logger.error(f"[{_scanner.server_type}]扫描失败：{e}")
+                error = error or e
+        if error is not None:
+            raise error
+        return dispatched
+
     def finish_scan(self):
         queue = set(self.pool)
         if len(queue) <= 0:
@@ -59,7 +103,10 @@ class ScanningPool(object):
         cache_parent_folder = {}
         path_based_queue = []
         for _p in queue:
-            if not self.storage_client.is_dir(_p):
+            _isdir = self.path_isdir.get(_p)
+            if _isdir is None:
+                _isdir = self.storage_client.is_dir(_p)
+            if not _isdir:
                 parent_of_p = os.path.dirname(_p)
                 path_based_queue.append(parent_of_p)
                 cache_isfile[_p] = True
@@ -81,40 +128,30 @@ class ScanningPool(object):
                 if cache_isfile[_v]:
                     sub_folder2mtimepath[cache_parent_folder[_v]] = mtimepath
 
-        # 开始扫描
-        for _scanner in self.scanners:
-            self.logger.info(f"Scanning on {_scanner.server_type} media server...")
-            if _scanner.isfile_based_scanning:
-                for _f in file_based_queue:
-                    rval = _scanner.scan_path(_f)
-                    if not rval:
-                        mtime_p = sub_folder2mtimepath[_f]
-                        mtimepath_scanned_marks[mtime_p] = False
-                        self.logger.error(f"扫描[{_f}]失败，将不更新目录[{mtime_p}]的mtime。")
-                    else:
-                        # self.logger.warning(f"- {_f}")
-                        pass
-            else:
-                for _p in path_based_queue:
-                    rval = _scanner.scan_path(_p)
-                    if not rval:
-                        mtime_p = sub_folder2mtimepath[_p]
-                        mtimepath_scanned_marks[mtime_p] = False
-                        self.logger.error(f"扫描[{_p}]失败，将不更新目录[{mtime_p}]的mtime!")
-                    else:
-                        # self.logger.warning(f"- {_p}")
-                        pass
+        # 开始扫描，结果按路径返回，以便将失败归属到对应的mtimepath
+        for _scanner, results in self.dispatch(file_based_queue, path_based_queue):
+            for _p, rval in results.items():
+                if not rval:
+                    mtime_p = sub_folder2mtimepath[_p]
+                    mtimepath_scanned_marks[mtime_p] = False
+                    self.logger.error(f"[{_scanner.server_type}]扫描[{_p}]失败，将不更新目录[{mtime_p}]的mtime!")
+        updated_mtimes = {}
         for mtimepath in self.wait_updating_mtimepaths.keys():
             if mtimepath_scanned_marks[mtimepath] and not cache_isfile.get(
                 mtimepath, False
             ):  # 如果mtimepath为文件，则不更新mtime
                 _mtime = self.mtimepath2mtime[mtimepath]
                 if _mtime:
-                    self.db.set(mtimepath, _mtime)
+                    updated_mtimes[mtimepath] = _mtime
                     self.logger.info(f"更新mtime: [{mtimepath}]=>{timestamp_to_datetime(_mtime)}")
+        # 批量写入mtime，并将对应目录的listing写入快照
+        self.db.set_many(updated_mtimes)
+        if self.snapshot is not None:
+            self.snapshot.commit(updated_mtimes.keys())
 
         self.wait_updating_mtimepaths.clear()
         self.mtimepath2mtime.clear()
+        self.path_isdir.clear()
         self.pool.clear()
 
 
@@ -151,80 +188,232 @@ class ScanningPool4DeletedPaths(ScanningPool):
                 path_based_queue.append(parent_of_p)
         path_based_queue = list(set(path_based_queue))
         # 开始扫描
+        for _scanner, results in self.dispatch(file_based_queue, path_based_queue, deleted=True):
+            for _p, rval in results.items():
+                if not rval:
+                    self.logger.error(f"[{_scanner.server_type}]扫描[{_p}]失败。")
+        self.pool.clear()
+
+
+class ScanningPool4MovedPaths(ScanningPool):
+    '''移动/重命名的文件（夹）：strm目录树在本地移动，原路径及新路径在同一次分发中通知媒体服务器，
+    扫描成功后已保存的mtime随目录一起移动，下一次定时遍历不必重新遍历被移动的子树
+    '''
+
+    def __init__(self, servers_cfg, storage_client, db, this_logger=logger):
+        super().__init__(servers_cfg, storage_client, db, this_logger)
+        self.moves = []
+
+    def put(self, src_path, dest_path):
+        self.moves.append((src_path, dest_path))
+
+    def is_dir(self, path):
+        try:
+            return self.storage_client.is_dir(path)
+        except Exception:
+            # FIXME: 通过splitext来粗略判断是否为文件夹，并不能百分百准确
+            return os.path.splitext(path)[1] == ''
+
+    def move_strm(self, moves):
         for _scanner in self.scanners:
-            self.logger.info(f"Scanning on {_scanner.server_type} media server...")
-            if _scanner.isfile_based_scanning:
-                for _f in file_based_queue:
-                    rval = _scanner.scan_path(_f, deleted=True)
-                    if not rval:
-                        self.logger.error(f"扫描[{_f}]失败。")
-                    else:
-                        # self.logger.warning(f"- {_f}")
-                        pass
+            processor = getattr(_scanner, 'strm_processor', None)
+            if processor is None:
+                continue
+            for src_path, dest_path in moves:
+                if processor.move(src_path, dest_path):
+                    continue
+                self.logger.warning(f"[{_scanner.server_type}]无法在本地移动[{src_path}]，删除后重新生成strm")
+                for path, kwargs in ((src_path, {'deleted': True}), (dest_path, {})):
+                    # 不在strm根目录映射范围内的一侧无需处理
+                    if not processor.dest_mapper.matches(path):
+                        continue
+                    try:
+                        processor.run(path, **kwargs)
+                    except Exception as e:
+                        self.logger.error(f"[{_scanner.server_type}]处理[{path}]失败：{e}")
+
+    def finish_scan(self):
+        moves = list(dict.fromkeys(self.moves))
+        if len(moves) <= 0:
+            return
+        self.move_strm(moves)
+        file_based_queue = []
+        path_based_queue = []
+        move2paths = {}
+        moved_folders = []
+        for src_path, dest_path in moves:
+            file_based_queue.extend([src_path, dest_path])
+            if self.is_dir(dest_path):
+                scan_paths = [src_path, dest_path]
+                moved_folders.append((src_path, dest_path))
             else:
-                for _p in path_based_queue:
-                    rval = _scanner.scan_path(_p, deleted=True)
+                scan_paths = [os.path.dirname(src_path), os.path.dirname(dest_path)]
+            path_based_queue.extend(scan_paths)
+            move2paths[(src_path, dest_path)] = {src_path, dest_path, *scan_paths}
+        path_based_queue = list(dict.fromkeys(path_based_queue))
+        failed_paths = set()
+        try:
+            deleted_paths = {src_path for src_path, _ in moves}
+            for _scanner, results in self.dispatch(
+                file_based_queue, path_based_queue, strm_handled=True, deleted_paths=deleted_paths
+            ):
+                for _p, rval in results.items():
                     if not rval:
-                        self.logger.error(f"扫描[{_p}]失败。")
-                    else:
-                        # self.logger.warning(f"- {_p}")
-                        pass
-        self.pool.clear()
+                        failed_paths.add(_p)
+                        self.logger.error(f"[{_scanner.server_type}]扫描[{_p}]失败。")
+        except Exception:
+            failed_paths.update(p for paths in move2paths.values() for p in paths)
+            raise
+        finally:
+            for src_path, dest_path in moved_folders:
+                if move2paths[(src_path, dest_path)] & failed_paths:
+                    # 扫描失败时只删除原路径的mtime，新路径在下一次定时遍历时重新扫描
+                    self.db.clear_subtree(src_path)
+                else:
+                    self.db.move_subtree(src_path, dest_path)
+            self.moves.clear()
 
 
 def path_scan_workder(
-    path,
+    dir_attr,
+    subs,
+    base_mtime,
     find_updated_folders_func,
     scanning_pool,
     storage_client,
-    db,
+    mtime_updates,
+    old_children=None,
+    snapshot=None,
     fetch_mtime_only=False,
     fetch_all_mode=False,
     this_logger=logger,
 ):
-    base_mtime = db.get(path)
-    new_mtime = storage_client.get_mtime(path)
+    '''dir_attr为目录自身的属性（来自父目录的listdir），subs为该目录listdir的结果，base_mtime为批量读取的数据库中的mtime；
+    old_children为快照中该目录的子文件（夹）名到mtime的映射；
+    仅更新mtime时，新的mtime写入mtime_updates，由调用方批量写库
+    '''
+    path = dir_attr['path']
+    new_mtime = storage_client.attr_mtime(dir_attr)
+    if snapshot is not None:
+        snapshot.stage(dir_attr, subs)
     if base_mtime is None or base_mtime != new_mtime:
         if not fetch_mtime_only:
             # 找出产生更新的子目录来进行扫库
-            updated_folders = find_updated_folders_func(path)
-            scanning_pool.put(new_mtime, path, updated_folders)
+            updated_attrs = find_updated_folders_func(dir_attr, subs, old_mtime=base_mtime, old_children=old_children)
+            scanning_pool.put(
+                new_mtime,
+                path,
+                [a['path'] for a in updated_attrs],
+                isdir_map={a['path']: storage_client.attr_is_dir(a) for a in updated_attrs},
+            )
             # db.set(path, new_mtime)
         elif fetch_all_mode or base_mtime is None:
-            db.set(path, new_mtime)
+            mtime_updates[path] = new_mtime
             # logger.info(f"Mtime of path[{path}] has been updated to {new_mtime}.")
             this_logger.info(f"更新mtime: [{path}]=>{timestamp_to_datetime(new_mtime)}")
 
 
-def fs_walk(storage_client, top: str, blacklist=[], **kwargs):
-    for path, dirs, _ in storage_client.walk_attr(top, topdown=True, **kwargs):
-        _dirs = [
-            d for d in dirs if not (d['path'] in blacklist or d['name'].startswith('.'))
-        ]  # not valid when topdown=False
-        dirs[:] = _dirs
-        yield path, [a["name"] for a in dirs]
+def get_top_attr(storage_client, top):
+    '''通过对父目录进行listdir来获取top的属性，确保top的mtime是最新的'''
+    parent = os.path.dirname(top)
+    if parent != top:
+        for a in storage_client.listdir_attr(parent, refresh=True):
+            if a['path'] == top:
+                return a
+    return storage_client.attr(top, refresh=True)
+
 
+def fs_walk(
+    storage_client,
+    top: str,
+    blacklist=[],
+    max_workers=None,
+    should_descend=None,
+    start_attrs=None,
+    frontier=None,
+    failures=None,
+    this_logger=logger,
+):
+    '''并发遍历目录树，同时最多有max_workers个listdir请求在进行；
+    某个目录的listdir一返回就产出(目录属性, 该目录listdir的结果)，因此不保证深度优先的顺序；
+    子目录的属性取自父目录的listdir结果，每个目录只需一次listdir；
+    黑名单中的目录及以"."开头的目录不会被继续遍历；should_descend(目录属性, listdir结果, 子目录属性)返回False的子目录也不会被继续遍历。
+    start_attrs不为None时，从这些目录（检查点中保存的frontier）继续遍历，而不是从top开始；
+    frontier为dict时，遍历过程中实时记录尚未产出的目录，用于保存检查点；listdir失败的目录保留在frontier中，
+    并记录到failures（list）中，由调用方在遍历结束后处理。
+    '''
+    if max_workers is None:
+        max_workers = storage_client.max_concurrent_listings
+    if frontier is None:
+        frontier = {}
+    if start_attrs is None:
+        start_attrs = [dict(get_top_attr(storage_client, top), path=top)]
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+    finished = False
+
+    def submit(attr):
+        pending[executor.submit(storage_client.listdir_attr, attr['path'], refresh=True)] = attr
+        frontier[attr['path']] = storage_client.compact_attr(attr)
 
-def find_updated_folders(top, blacklist, storage_client, db):
+    try:
+        for attr in start_attrs:
+            submit(attr)
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                dir_attr = pending.pop(future)
+                try:
+                    subs = future.result()
+                except Exception as e:
+                    this_logger.error(f"遍历目录[{dir_attr['path']}]失败! 错误信息: {e}")
+                    if failures is not None:
+                        failures.append(dir_attr['path'])
+                    continue
+                frontier.pop(dir_attr['path'], None)
+                for a in subs:
+                    if not storage_client.attr_is_dir(a) or a['path'] in blacklist or a['name'].startswith('.'):
+                        continue
+                    if should_descend is None or should_descend(dir_attr, subs, a):
+                        submit(a)
+                yield dir_attr, subs
+        finished = True
+    finally:
+        # 调用方提前结束遍历（如处理时抛出异常）时，取消排队中的listdir，不再等待其完成
+        executor.shutdown(wait=finished, cancel_futures=not finished)
+
+
+def find_updated_folders(top_attr, subs, blacklist, storage_client, old_mtime, old_children=None):
     '''找出哪个子目录或者文件变更了，只遍历一级深度（不进行向下递归）；
-    比较子文件（夹）的mtime和top目录在数据库中的old_mtime，如果子文件（夹）的mtime大于top的old_mtime，则认为该子文件（夹）发生了变更；
+    若快照中有top的子文件（夹）记录old_children，则与快照对比，新增或mtime变化的子文件（夹）即为变更；
+    否则比较子文件（夹）的mtime和top目录在数据库中的old_mtime，如果子文件（夹）的mtime大于top的old_mtime，则认为该子文件（夹）发生了变更；
+    子文件（夹）的mtime直接取自top的listdir结果subs，返回变更的子文件（夹）的属性列表
     '''
-    updated_folders = []
-    subs = storage_client.listdir_attr(top)
-    old_mtime = db.get(top)
-    if bool(old_mtime):
-        old_mtime = float(old_mtime)
+    updated_attrs = []
+    if bool(old_mtime) and old_children is not None:
+        for sub in subs:
+            if sub['path'] in blacklist or sub['name'].startswith("."):
+                continue
+            if old_children.get(sub['name']) != storage_client.attr_mtime(sub):
+                updated_attrs.append(sub)
+        if set(old_children) - set(a['name'] for a in subs):  # 删除了子文件（夹）
+            updated_attrs.append(top_attr)
+            return updated_attrs
+    elif bool(old_mtime):
+        old_mtime_value = float(old_mtime)
         for sub in subs:
             sub_full_path = sub['path']
             if sub_full_path in blacklist or sub['name'].startswith("."):
                 continue
-            sub_mtime = float(storage_client.get_mtime(sub_full_path))
-            if sub_mtime > old_mtime:
-                updated_folders.append(sub_full_path)
+            sub_mtime = float(storage_client.attr_mtime(sub))
+            if sub_mtime > old_mtime_value:
+                updated_attrs.append(sub)
                 # BUG: 如果新增了folder，此处未将其mtime写入db，当下次遍历目录比对mtime时，会再次扫描该folder。此处摆烂，允许media server再次扫描。
-    if len(updated_folders) == 0 and (storage_client.get_mtime(top) != str(old_mtime)):  # 可能删除了子文件（夹）
-        updated_folders.append(top)
-    return updated_folders
+    if len(updated_attrs) == 0 and (
+        storage_client.attr_mtime(top_attr) != old_mtime
+    ):  # 可能删除了子文件（夹）
+        updated_attrs.append(top_attr)
+    return updated_attrs
 
 
 def folder_scan(
@@ -236,6 +425,41 @@ def folder_scan(
     fetch_mtime_only=False,
     fetch_all_mode=False,
     this_logger=logger,
+):
+    # 同一目录同时只允许一个遍历任务，避免定时任务与celery任务互相覆盖检查点、快照
+    scan_lock = db.scan_lock(_folder)
+    if not scan_lock.acquire():
+        this_logger.warning(f"目录[{_folder}]正在被其他任务遍历，跳过本次遍历")
+        return
+    try:
+        _folder_scan(
+            _folder,
+            _blacklist,
+            servers_cfg,
+            storage_client,
+            db,
+            scan_lock,
+            fetch_mtime_only=fetch_mtime_only,
+            fetch_all_mode=fetch_all_mode,
+            this_logger=this_logger,
+        )
+    except ScanLockLost as e:
+        # 锁过期后已由其他任务接管该目录的遍历，本次遍历的检查点等状态交由其处理
+        this_logger.error(f"目录[{_folder}]的遍历已停止: {e}")
+    finally:
+        scan_lock.release()
+
+
+def _folder_scan(
+    _folder,
+    _blacklist,
+    servers_cfg,
+    storage_client,
+    db,
+    scan_lock,
+    fetch_mtime_only=False,
+    fetch_all_mode=False,
+    this_logger=logger,
 ):
     # config = YAMLCONFIG.get()
     # BEGIN OF MONITORING
@@ -250,32 +474,153 @@ def folder_scan(
     this_logger.info(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")  # fmt: skip
     this_logger.info(f"目录[{_folder}]的{MODE}@{t_start.replace(microsecond=0)}开始...")
 
+    db.reset_round_trips()
     find_updated_folders_func = functools.partial(
         find_updated_folders,
         blacklist=_blacklist,
         storage_client=storage_client,
-        db=db,
     )
-    scanning_pool = ScanningPool(servers_cfg=servers_cfg, storage_client=storage_client, db=db, this_logger=this_logger)
+    snapshot = db.snapshot(_folder, storage_client)
+    descend_checks = []
+    if snapshot is not None:
+        # 未开启剪枝时也需要载入，mtime未变化且listing与快照一致的目录无需重写快照
+        this_logger.info(f"已载入{snapshot.load()}个目录的快照")
+        if db.prune_unchanged_subtrees:
+            descend_checks.append(snapshot.should_descend)
+    # 仅更新mtime时需要完整遍历，不使用自适应间隔
+    adaptive = db.adaptive_polling(_folder, storage_client) if not fetch_mtime_only else None
+    if adaptive is not None:
+        adaptive.load()
+        descend_checks.append(adaptive.should_descend)
+    should_descend = None
+    if descend_checks:
+        should_descend = lambda *args: all(check(*args) for check in descend_checks)
+    scanning_pool = ScanningPool(
+        servers_cfg=servers_cfg, storage_client=storage_client, db=db, this_logger=this_logger, snapshot=snapshot
+    )
+    # 从检查点恢复
+    checkpoint = db.checkpoint(_folder, MODE)
+    start_attrs = None
+    if checkpoint is not None:
+        state = checkpoint.load()
+        if state is not None:
+            scanning_pool.load_state(state['pool'])
+            if snapshot is not None and state['snapshot']:
+                snapshot.load_staged(state['snapshot'])
+            if adaptive is not None and state['adaptive']:
+                adaptive.load_state(state['adaptive'])
+            if state.get('phase') == ScanCheckpoint.PHASE_PENDING_DISPATCH:
+                # 上次遍历已完成但扫描失败：保留待扫描的内容，重新完整遍历以发现期间的新变更
+                this_logger.warning(
+                    f"{timestamp_to_datetime(state['saved_at'])}的遍历扫描失败，"
+                    f"重新遍历并扫描遗留的{len(state['pool']['pool'])}个路径"
+                )
+            else:
+                start_attrs = state['frontier']
+                this_logger.warning(
+                    f"从{timestamp_to_datetime(state['saved_at'])}的检查点继续：待遍历{len(start_attrs)}个目录，"
+                    f"待扫描{len(state['pool']['pool'])}个路径"
+                )
 
     worker_partial = functools.partial(
         path_scan_workder,
         find_updated_folders_func=find_updated_folders_func,
         scanning_pool=scanning_pool,
         storage_client=storage_client,
-        db=db,
+        snapshot=snapshot,
         fetch_mtime_only=fetch_mtime_only,
         fetch_all_mode=fetch_all_mode,
         this_logger=this_logger,
     )
+
+    def scan_batch(batch):
+        # 批量读取一批目录的mtime，处理后再批量写回
+        scan_lock.check()
+        mtime_updates = {}
+        base_mtimes = db.get_many([dir_attr['path'] for dir_attr, _ in batch])
+        old_children_map = {}
+        stale_snapshot_paths = []  # mtime未变化但listing与快照不一致的目录
+        up_to_date_paths = []  # mtime及listing均与快照一致的目录，无需重写快照
+        if snapshot is not None:
+            changed_paths = []
+            for (dir_attr, subs), base_mtime in zip(batch, base_mtimes):
+                if base_mtime is not None and base_mtime == storage_client.attr_mtime(dir_attr):
+                    if snapshot.is_unchanged(dir_attr, subs):
+                        up_to_date_paths.append(dir_attr['path'])
+                    else:
+                        stale_snapshot_paths.append(dir_attr['path'])
+                else:
+                    changed_paths.append(dir_attr['path'])
+            if not fetch_mtime_only:
+                old_children_map = snapshot.get_children_many(changed_paths)
+        for (dir_attr, subs), base_mtime in zip(batch, base_mtimes):
+            if adaptive is not None and base_mtime != storage_client.attr_mtime(dir_attr):
+                adaptive.mark_changed(dir_attr['path'])
+            worker_partial(
+                dir_attr, subs, base_mtime, mtime_updates=mtime_updates, old_children=old_children_map.get(dir_attr['path'])
+            )
+        db.set_many(mtime_updates)
+        if snapshot is not None:
+            snapshot.discard_staged(up_to_date_paths)
+            # mtime未变化但快照过期、或已写库的目录，其listing直接写入快照；等待扫描的目录在扫描成功后写入
+            snapshot.commit(stale_snapshot_paths + list(mtime_updates.keys()))
+        batch.clear()
+
+    def save_checkpoint(phase=ScanCheckpoint.PHASE_WALKING):
+        scan_lock.check()
+        checkpoint.save(
+            frontier=list(frontier.values()),
+            pool_state=scanning_pool.dump_state(),
+            snapshot_state=snapshot.dump_staged() if snapshot is not None else None,
+            adaptive_state=adaptive.dump_state() if adaptive is not None else None,
+            phase=phase,
+        )
+
     # 监测子目录、子文件
-    for root, _ in fs_walk(storage_client, top=_folder, blacklist=_blacklist):
-        storage_client.listdir_attr(os.path.dirname(root))  # 对父目录进行listdir，确保top的mtime被更新
-        worker_partial(root)
-    try:
-        scanning_pool.finish_scan()
-    except Exception as e:
-        this_logger.error(f"Error: {e}")
+    batch = []
+    frontier = {}
+    walk_failures = []
+    for dir_attr, subs in fs_walk(
+        storage_client,
+        top=_folder,
+        blacklist=_blacklist,
+        should_descend=should_descend,
+        start_attrs=start_attrs,
+        frontier=frontier,
+        failures=walk_failures,
+        this_logger=this_logger,
+    ):
+        batch.append((dir_attr, subs))
+        if len(batch) >= db.batch_size:
+            scan_batch(batch)
+            # 仅在一批目录处理完后保存检查点，此时已产出的目录均已处理，其余目录都在frontier中
+            if checkpoint is not None and checkpoint.is_due():
+                save_checkpoint()
+    scan_batch(batch)
+    if walk_failures and checkpoint is not None:
+        # 遍历不完整：失败的目录保留在frontier中，保存检查点后结束，下次从这些目录继续遍历后再扫描
+        save_checkpoint()
+        scanned = False
+    else:
+        if checkpoint is not None:
+            # 遍历完成，扫描前保存一次检查点，扫描失败或中断时下次重新遍历并扫描
+            save_checkpoint(phase=ScanCheckpoint.PHASE_PENDING_DISPATCH)
+        try:
+            scanning_pool.finish_scan()
+            scanned = True
+        except Exception as e:
+            this_logger.error(f"Error: {e}")
+            scanned = False
+        # 扫描期间失去了锁时，检查点及自适应间隔由接管的任务处理
+        scan_lock.check()
+        if scanned and checkpoint is not None and not walk_failures:
+            checkpoint.discard()
+    if adaptive is not None:
+        this_logger.info(f"自适应间隔：本次跳过{adaptive.skipped}个未到期的子树")
+        # 遍历不完整或扫描失败时不更新各子树的间隔，下次仍按原间隔遍历
+        if scanned and not walk_failures:
+            adaptive.commit()
+    this_logger.info(f"Redis round trips: {db.round_trips}")
 
     # END OF MONITORING
     t_end = datetime.now()
@@ -287,6 +632,8 @@ def folder_scan(
         this_logger.info(f"Time cost: {total_minutes:.2f} minutes!")
     this_logger.info(f"目录[{_folder}]的{MODE}@{t_end.replace(microsecond=0)}结束!")
     this_logger.info("<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<")  # fmt: skip
+    if walk_failures:
+        raise OSError(f"目录[{_folder}]中有{len(walk_failures)}个目录遍历失败: {walk_failures[:10]}")
 
 
 def create_folder_scheduler(
@@ -341,14 +688,34 @@ def manual_scan(scan_path, servers_cfg, storage_client, db):
 
 
 def manual_scan_dest_pathlist(path_list, servers_cfg, storage_client, db, this_logger=logger):
+    '''扫描新增的路径，返回获取mtime失败（如已被删除）而未扫描的路径'''
     scanning_pool = ScanningPool(servers_cfg=servers_cfg, storage_client=storage_client, db=db, this_logger=this_logger)
+    failed_paths = []
     for p in path_list:
-        mtime = storage_client.get_mtime(p)
+        try:
+            mtime = storage_client.get_mtime(p)
+        except Exception as e:
+            this_logger.error(f"获取路径[{p}]的mtime失败，跳过该路径! 错误信息: {e}")
+            failed_paths.append(p)
+            continue
         scanning_pool.put(mtime, p, p)
     try:
         scanning_pool.finish_scan()
     except Exception as e:
         this_logger.error(f"Error: {e}")
+    return failed_paths
+
+
+def manual_scan_moved_pathlist(move_list, servers_cfg, storage_client, db, this_logger=logger):
+    scanning_pool = ScanningPool4MovedPaths(
+        servers_cfg=servers_cfg, storage_client=storage_client, db=db, this_logger=this_logger
+    )
+    for src_path, dest_path in move_list:
+        scanning_pool.put(src_path, dest_path)
+    try:
+        scanning_pool.finish_scan()
+    except Exception as e:
+        this_logger.error(f"Error: {e}")
 
 
 def manual_scan_deleted_pathlist(path_list, servers_cfg, storage_client, db, this_logger=logger):
@@ -356,12 +723,16 @@ def manual_scan_deleted_pathlist(path_list, servers_cfg, storage_client, db, thi
         servers_cfg=servers_cfg, storage_client=storage_client, db=db, this_logger=this_logger
     )
     _knwon_file_exts = scanning_pool.known_file_exts
+    deleted_folders = []
     for p in path_list:
         ext = os.path.splitext(p)[1]
         # FIXME: 通过splitext来粗略判断是否为文件夹，并不能百分百准确
         if ext == '' or ext not in _knwon_file_exts:
-            db.delete(p)
+            deleted_folders.append(p)
         scanning_pool.put(p)
+    # 删除的文件夹连同其子孙目录的mtime一起清空
+    for folder in deleted_folders:
+        db.clear_subtree(folder)
     try:
         scanning_pool.finish_scan()
     except Exception as e:
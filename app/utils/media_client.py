@@ -0,0 +1,212 @@
+import time
+import threading
+from contextlib import contextmanager
+import requests
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .pytimeparse import timeparse
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class CircuitOpenError(RequestException):
+    '''媒体服务器的熔断器处于打开状态，请求未发出'''
+
+
+class MediaServerClient(object):
+    '''媒体服务器的HTTP客户端：复用连接池（keep-alive），设置连接/读取超时及有限次数的重试，
+    连续失败达到failure_threshold次后熔断，reset_timeout秒内的请求直接失败，之后放行一次试探请求，成功则恢复。
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name,
+        host,
+        connect_timeout=5,
+        read_timeout=30,
+        retries=2,
+        failure_threshold=5,
+        reset_timeout=60,
+        pool_size=10,
+        max_concurrent_dispatches=2,
+    ):
+        self.name = name
+        self.host = host
+        self.timeout = (connect_timeout, read_timeout)
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=0.5,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # 同时向该服务器分发扫描队列的ScanningPool数量上限
+        self.max_concurrent_dispatches = max(1, max_concurrent_dispatches)
+        self.dispatch_semaphore = threading.BoundedSemaphore(self.max_concurrent_dispatches)
+        self.active_dispatches = 0
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.last_latency = None
+        self.last_error = None
+
+    @contextmanager
+    def dispatch_slot(self):
+        self.dispatch_semaphore.acquire()
+        with self._lock:
+            self.active_dispatches += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active_dispatches -= 1
+            self.dispatch_semaphore.release()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"[{self.name}] 媒体服务器[{self.host}]不可用，已熔断，暂停发送请求")
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self.trial_in_flight:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"[{self.name}] 媒体服务器[{self.host}]正在恢复中，暂停发送请求")
+                self.trial_in_flight = True
+
+    def on_success(self, latency):
+        with self._lock:
+            self.requests += 1
+            self.total_latency += latency
+            self.last_latency = latency
+            if self.state != self.CLOSED:
+                logger.warning(f"[{self.name}] 媒体服务器[{self.host}]已恢复")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+
+    def on_failure(self, latency, error):
+        with self._lock:
+            self.requests += 1
+            self.failures += 1
+            self.total_latency += latency
+            self.last_latency = latency
+            self.last_error = str(error)
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.error(
+                        f"[{self.name}] 媒体服务器[{self.host}]连续失败{self.consecutive_failures}次，"
+                        f"熔断{self.reset_timeout}秒"
+                    )
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+        '''经过熔断器调用func，func抛出异常时记为失败'''
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.on_failure(time.monotonic() - start, e)
+            raise
+        self.on_success(time.monotonic() - start)
+        return result
+
+    def request(self, method, path, **kwargs):
+        '''请求host + path，5xx响应同样记为失败，但仍返回响应'''
+        kwargs.setdefault('timeout', self.timeout)
+        self.before_call()
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, self.host + path, **kwargs)
+        except Exception as e:
+            self.on_failure(time.monotonic() - start, e)
+            raise
+        if response.status_code >= 500:
+            self.on_failure(time.monotonic() - start, f"HTTP {response.status_code}")
+        else:
+            self.on_success(time.monotonic() - start)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'host': self.host,
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'requests': self.requests,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'active_dispatches': self.active_dispatches,
+                'max_concurrent_dispatches': self.max_concurrent_dispatches,
+                'avg_latency': round(self.total_latency / self.requests, 3) if self.requests else None,
+                'last_latency': round(self.last_latency, 3) if self.last_latency is not None else None,
+                'last_error': self.last_error,
+            }
+
+
+_clients = {}  # (name, host) -> (客户端的配置, 客户端)
+_clients_lock = threading.Lock()
+
+
+def get_media_client(name, server_cnf):
+    '''按服务器复用同一个客户端（连接池及熔断状态在进程内共享），客户端相关的配置变化时重建客户端'''
+    host = server_cnf['host']
+    breaker_cnf = server_cnf.get('circuit_breaker', {}) or {}
+    timeout_cnf = server_cnf.get('timeout', {}) or {}
+    options = dict(
+        connect_timeout=float(timeout_cnf.get('connect', 5)),
+        read_timeout=float(timeout_cnf.get('read', 30)),
+        retries=int(server_cnf.get('retries', 2)),
+        failure_threshold=int(breaker_cnf.get('failure_threshold', 5)),
+        reset_timeout=timeparse(str(breaker_cnf.get('reset_timeout', '1m'))),
+        max_concurrent_dispatches=int(server_cnf.get('max_concurrent_dispatches', 2)),
+    )
+    with _clients_lock:
+        cached = _clients.get((name, host))
+        if cached is not None and cached[0] == options:
+            return cached[1]
+        if cached is not None:
+            logger.info(f"媒体服务器[{name}]的客户端配置已变化，重建客户端")
+        client = MediaServerClient(name, host, **options)
+        _clients[(name, host)] = (options, client)
+        return client
+
+
+def media_clients_stats():
+    with _clients_lock:
+        clients = [client for _, client in _clients.values()]
+    return [c.stats() for c in clients]
@@ -34,5 +34,18 @@ def timestamp_to_datetime(timestamp):
     return dt
 
 
+def seconds_to_readable(seconds):
+    '''将秒数转换为"1d2h"、"30m"这样的可读形式'''
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    parts = []
+    for unit, unit_secs in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= unit_secs:
+            parts.append(f"{seconds // unit_secs}{unit}")
+            seconds %= unit_secs
+    return ''.join(parts[:2])
+
+
 def current_time():
     return datetime.now().replace(microsecond=0)
@@ -0,0 +1,182 @@
+import functools
+import posixpath
+from collections import defaultdict
+
+
+class _Node(object):
+    __slots__ = ('children', 'terminal', 'value')
+
+    def __init__(self):
+        self.children = {}
+        self.terminal = False
+        self.value = None
+
+
+class PathTrie(object):
+    '''按路径组件（以/分隔）组织的前缀树，/foo不会被当作/foobar的前缀'''
+
+    def __init__(self, paths=None):
+        self.root = _Node()
+        self.size = 0
+        for p in paths or []:
+            self.insert(p)
+
+    @staticmethod
+    def split(path):
+        return [c for c in path.split('/') if c]
+
+    @staticmethod
+    def join(parts):
+        return '/' + '/'.join(parts)
+
+    def insert(self, path, value=None):
+        node = self.root
+        for c in self.split(path):
+            node = node.children.setdefault(c, _Node())
+        if not node.terminal:
+            self.size += 1
+        node.terminal = True
+        node.value = value
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, path):
+        node = self.root
+        for c in self.split(path):
+            node = node.children.get(c)
+            if node is None:
+                return False
+        return node.terminal
+
+    def remove(self, path):
+        '''删除路径，同时清理不再有子节点的中间节点；路径不存在时返回False'''
+        node = self.root
+        stack = []
+        for c in self.split(path):
+            child = node.children.get(c)
+            if child is None:
+                return False
+            stack.append((node, c))
+            node = child
+        if not node.terminal:
+            return False
+        node.terminal = False
+        node.value = None
+        self.size -= 1
+        while stack and not node.terminal and not node.children:
+            parent, c = stack.pop()
+            del parent.children[c]
+            node = parent
+        return True
+
+    def iter_under(self, path):
+        '''树中位于path之下的路径（不含path本身）'''
+        node = self.root
+        parts = self.split(path)
+        for c in parts:
+            node = node.children.get(c)
+            if node is None:
+                return
+        stack = [(parts + [c], child) for c, child in node.children.items()]
+        while stack:
+            parts, node = stack.pop()
+            if node.terminal:
+                yield self.join(parts)
+            for c, child in node.children.items():
+                stack.append((parts + [c], child))
+
+    def longest_prefix(self, path):
+        '''返回树中是path本身或其祖先的最长路径及其值，不存在时返回(None, None)'''
+        node = self.root
+        parts = self.split(path)
+        found = (self.join([]), node.value) if node.terminal else (None, None)
+        for i, c in enumerate(parts):
+            node = node.children.get(c)
+            if node is None:
+                break
+            if node.terminal:
+                found = (self.join(parts[: i + 1]), node.value)
+        return found
+
+    def covering_set(self):
+        '''不相互包含的最少路径集合：已被祖先覆盖的路径会被去除'''
+        result = []
+        stack = [([], self.root)]
+        while stack:
+            parts, node = stack.pop()
+            if node.terminal:
+                result.append(self.join(parts))
+                continue
+            for c, child in node.children.items():
+                stack.append((parts + [c], child))
+        return result
+
+
+def coalesce_paths(paths, collapse_threshold=0, can_collapse=None):
+    '''将路径合并为最少的不相互包含的目录集合，返回 原路径 -> 覆盖它的路径；
+    collapse_threshold大于0时，同一父目录下超过该数量的路径合并为父目录（can_collapse(父目录)为True时）
+    '''
+    paths = list(paths)
+    covers = PathTrie(paths).covering_set()
+    if collapse_threshold > 0:
+        while True:
+            siblings = defaultdict(list)
+            for p in covers:
+                if p != '/':
+                    siblings[posixpath.dirname(p)].append(p)
+            parents = [
+                parent
+                for parent, subs in siblings.items()
+                if len(subs) > collapse_threshold and (can_collapse is None or can_collapse(parent))
+            ]
+            if not parents:
+                break
+            covers = PathTrie(covers + parents).covering_set()
+    trie = PathTrie(covers)
+    return {p: trie.longest_prefix(p)[0] for p in paths}
+
+
+def paths_overlap(a, b):
+    '''a与b是同一路径，或其中一个是另一个的祖先'''
+    a, b = a.rstrip('/') or '/', b.rstrip('/') or '/'
+    if len(a) > len(b):
+        a, b = b, a
+    return a == b or a == '/' or b.startswith(a + '/')
+
+
+class PathMapper(object):
+    '''按根目录映射路径：最长前缀匹配，只在路径组件的边界上匹配，结果带LRU缓存；
+    rules为[(源根目录, 目标根目录)]，map为源 -> 目标，reverse为目标 -> 源；
+    未匹配任何规则时返回None，由调用方跳过该路径，passthrough为True时原样返回（如媒体服务器的可选路径映射）
+    '''
+
+    def __init__(self, rules, cache_size=4096, passthrough=False):
+        self.passthrough = passthrough
+        self.rules = [(src, dest) for src, dest in rules if src]
+        self._forward = PathTrie()
+        self._backward = PathTrie()
+        for src, dest in self.rules:
+            self._forward.insert(src, dest)
+            self._backward.insert(dest, src)
+        self.map = functools.lru_cache(maxsize=cache_size)(functools.partial(self._translate, self._forward))
+        self.reverse = functools.lru_cache(maxsize=cache_size)(functools.partial(self._translate, self._backward))
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def _translate(self, trie, path):
+        prefix, target = trie.longest_prefix(path)
+        if prefix is None:
+            return path if self.passthrough else None
+        rest = PathTrie.split(path)[len(PathTrie.split(prefix)) :]
+        if not rest:
+            return target
+        return target.rstrip('/') + '/' + '/'.join(rest)
+
+    def matches(self, path):
+        '''path是否位于某个源根目录下'''
+        return self._forward.longest_prefix(path)[0] is not None
+
+    def cache_info(self):
+        return {'map': self.map.cache_info()._asdict(), 'reverse': self.reverse.cache_info()._asdict()}
@@ -0,0 +1,191 @@
+import time
+import threading
+from contextlib import contextmanager
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class AdaptiveRateController(object):
+    '''网盘接口调用的自适应（AIMD）并发及速率控制：
+    调用成功时，每个窗口（并发上限次成功调用 / 每秒速率次成功调用）将并发上限及速率各加increase_step；
+    遇到限流或超时时，将并发上限及速率乘以decrease_factor，同一cooldown时间内只降低一次。
+    throttle_keywords为额外判定为限流的错误信息关键词（不区分大小写），默认不按错误信息判定。
+    等待超过max_wait仍未获得调用配额的请求将被拒绝。
+    '''
+
+    # 按错误类型判定限流/超时：HTTP状态码、gRPC状态码（clouddrive2）及超时类异常，不匹配错误信息中的文字
+    THROTTLE_STATUS_CODES = {429}
+    THROTTLE_GRPC_CODES = {'RESOURCE_EXHAUSTED', 'DEADLINE_EXCEEDED'}
+    TIMEOUT_EXCEPTION_NAMES = {'TimeoutError', 'Timeout', 'TimeoutException', 'ReadTimeout', 'ConnectTimeout'}
+    MIN_RATE_FLOOR = 0.1  # 限流后速率的最小值（次/秒），速率降为0会使请求永远等待
+
+    def __init__(
+        self,
+        name,
+        initial_concurrency,
+        min_concurrency=1,
+        max_concurrency=8,
+        min_rate=1,
+        max_rate=0,
+        increase_step=1,
+        decrease_factor=0.5,
+        cooldown=5,
+        max_wait=300,
+        throttle_keywords=None,
+    ):
+        self.name = name
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.concurrency = float(min(max(initial_concurrency, self.min_concurrency), self.max_concurrency))
+        # max_rate为0时不限制速率
+        self.max_rate = max_rate
+        self.min_rate = min(max(min_rate, self.MIN_RATE_FLOOR), max_rate) if max_rate > 0 else 0
+        self.rate = float(max_rate)
+        self.increase_step = increase_step
+        self.decrease_factor = min(max(decrease_factor, 0.1), 0.9)
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+        self.throttle_keywords = [k.lower() for k in (throttle_keywords or [])]
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._tokens = max(1.0, self.rate)
+        self._refilled_at = time.monotonic()
+        self._last_decrease = 0
+        self.succeeded = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.last_throttle_at = None
+        self.total_latency = 0.0
+
+    @property
+    def limit(self):
+        return int(self.concurrency)
+
+    def _refill(self, now):
+        if self.max_rate <= 0:
+            return
+        self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self):
+        '''获取一次调用配额，超过max_wait时拒绝并抛出OSError'''
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._in_flight < self.limit and (self.max_rate <= 0 or self._tokens >= 1):
+                    self._in_flight += 1
+                    if self.max_rate > 0:
+                        self._tokens -= 1
+                    return
+                if now >= deadline:
+                    self.rejected += 1
+                    raise OSError(f"[{self.name}] 等待调用配额超过{self.max_wait}秒，已拒绝请求")
+                wait = deadline - now
+                if self._in_flight < self.limit:
+                    # 仅受速率限制，等待令牌补充
+                    wait = min(wait, (1 - self._tokens) / self.rate)
+                self._cond.wait(wait)
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @staticmethod
+    def status_code_of(e):
+        '''异常携带的HTTP状态码（requests、httpx、urllib3等），没有时返回None'''
+        for obj in (e, getattr(e, 'response', None)):
+            for attr in ('status_code', 'status'):
+                value = getattr(obj, attr, None)
+                if isinstance(value, int):
+                    return value
+        return None
+
+    @staticmethod
+    def grpc_code_of(e):
+        '''grpc.RpcError的状态码名称，没有时返回None'''
+        code = getattr(e, 'code', None)
+        if not callable(code):
+            return None
+        try:
+            return getattr(code(), 'name', None)
+        except Exception:
+            return None
+
+    def is_throttle_error(self, e):
+        # 依次检查异常及其引发原因（raise ... from ...）
+        seen = set()
+        while e is not None and id(e) not in seen:
+            seen.add(id(e))
+            if any(cls.__name__ in self.TIMEOUT_EXCEPTION_NAMES for cls in type(e).__mro__):
+                return True
+            if self.status_code_of(e) in self.THROTTLE_STATUS_CODES:
+                return True
+            if self.grpc_code_of(e) in self.THROTTLE_GRPC_CODES:
+                return True
+            if self.throttle_keywords:
+                message = str(e).lower()
+                if any(k in message for k in self.throttle_keywords):
+                    return True
+            e = e.__cause__ or e.__context__
+        return False
+
+    def on_success(self, latency):
+        with self._cond:
+            self.succeeded += 1
+            self.total_latency += latency
+            if time.monotonic() - self._last_decrease < self.cooldown:
+                return
+            self.concurrency = min(self.max_concurrency, self.concurrency + self.increase_step / self.concurrency)
+            if self.max_rate > 0:
+                self.rate = min(self.max_rate, self.rate + self.increase_step / self.rate)
+            self._cond.notify_all()
+
+    def on_throttle(self, e):
+        with self._cond:
+            self.throttled += 1
+            self.last_throttle_at = time.time()
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease_factor)
+            if self.max_rate > 0:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self._tokens = min(self._tokens, 0)
+            logger.warning(
+                f"[{self.name}] 触发限流，并发上限降为{self.limit}"
+                + (f"，速率降为{self.rate:.2f}次/秒" if self.max_rate > 0 else "")
+                + f"：{e}"
+            )
+
+    def backoff(self, attempt):
+        '''重试前的等待时间（秒），随重试次数指数增长'''
+        return min(self.cooldown * (2**attempt), 60)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'name': self.name,
+                'limit': self.limit,
+                'min_limit': self.min_concurrency,
+                'max_limit': self.max_concurrency,
+                'rate': round(self.rate, 2) if self.max_rate > 0 else None,
+                'in_flight': self._in_flight,
+                'succeeded': self.succeeded,
+                'throttled': self.throttled,
+                'rejected': self.rejected,
+                'last_throttle_at': self.last_throttle_at,
+                'avg_latency': round(self.total_latency / self.succeeded, 3) if self.succeeded else None,
+            }
@@ -0,0 +1,64 @@
+import threading
+from redis.exceptions import LockError, LockNotOwnedError
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class ScanLockLost(RuntimeError):
+    '''遍历过程中失去了目录的遍历锁（续期失败，锁已过期并可能被其他任务获取）'''
+
+
+class ScanLock(object):
+    '''目录遍历的redis锁：获取后由后台线程每ttl/3秒续期一次，覆盖遍历及扫描的全过程，
+    持有锁的进程退出后最多ttl秒自动释放。续期时发现锁已不属于自己，则标记为lost，遍历在下一个检查点停止。
+    '''
+
+    def __init__(self, redis_lock, name, ttl):
+        self.lock = redis_lock
+        self.name = name
+        self.ttl = ttl
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        if not self.lock.acquire(blocking=False):
+            return False
+        self.lost.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._renew, name=f'scan-lock-{self.name}', daemon=True)
+        self._thread.start()
+        return True
+
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.lock.reacquire()
+            except LockNotOwnedError:
+                logger.error(f"目录[{self.name}]的遍历锁已过期，停止本次遍历")
+                self.lost.set()
+                return
+            except Exception as e:
+                # redis暂时不可用时下一次再续期，锁在ttl内仍有效
+                logger.warning(f"续期目录[{self.name}]的遍历锁失败: {e}")
+
+    @property
+    def is_lost(self):
+        return self.lost.is_set()
+
+    def check(self):
+        if self.lost.is_set():
+            raise ScanLockLost(f"目录[{self.name}]的遍历锁已被其他任务获取")
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.lost.is_set():
+            return
+        try:
+            self.lock.release()
+        except LockError as e:
+            logger.warning(f"释放目录[{self.name}]的遍历锁失败: {e}")
@@ -1,24 +1,59 @@
 import os, sys, time
+import posixpath
+import json
+import threading
+import queue
 import shutil
 from pathlib import Path
 from plexapi.server import PlexServer
 from urllib.parse import quote_plus
-import requests
 from requests import RequestException
 from app.utils import getLogger
+from .path_trie import PathTrie, PathMapper, coalesce_paths
+from .strm_manifest import StrmManifest
+from .download_queue import MetadataDownloadQueue
+from .media_client import get_media_client
+from .pytimeparse import timeparse
+from .others import str2bool
 import concurrent.futures
+from collections import defaultdict, OrderedDict
 from clouddrive import CloudDrivePath
 
 logger = getLogger(__name__)
 
 
-def is_subpath(_path: Path, _parent: Path) -> bool:
+class LibraryIndex(object):
     """
-    Determine if _path is a subdirectory of _parent.
+    Longest-prefix index from library locations to library ids, answered in memory
+    without touching the filesystem. Paths outside every library are remembered in
+    a bounded negative cache.
     """
-    _path = _path.resolve()
-    _parent = _parent.resolve()
-    return _path.parts[: len(_parent.parts)] == _parent.parts
+
+    def __init__(self, negative_cache_size=4096):
+        self.trie = PathTrie()
+        self.negative_cache = OrderedDict()
+        self.negative_cache_size = negative_cache_size
+
+    def add(self, location: str, library):
+        self.trie.insert(posixpath.normpath(location), library)
+        self.negative_cache.clear()
+
+    def clear(self):
+        self.trie = PathTrie()
+        self.negative_cache.clear()
+
+    def lookup(self, path: str) -> str:
+        path = posixpath.normpath(str(path))
+        if path in self.negative_cache:
+            self.negative_cache.move_to_end(path)
+            return ""
+        prefix, library = self.trie.longest_prefix(path)
+        if prefix is not None:
+            return library
+        self.negative_cache[path] = True
+        if len(self.negative_cache) > self.negative_cache_size:
+            self.negative_cache.popitem(last=False)
+        return ""
 
 
 def get_path_mapping_rules(server_config):
@@ -34,10 +69,69 @@ def get_path_mapping_rules(server_config):
         return []
 
 
+class SourceListing(object):
+    '''一次网盘目录树遍历得到的文件、文件夹，以及被跳过（未遍历）的文件夹'''
+
+    def __init__(self):
+        self.files = set()
+        self.dirs = set()
+        self.skipped_dirs = set()
+        self.sizes = {}
+
+
+class StrmRunResult(object):
+    '''一次StrmProcessor.run的状态及结果，每次运行互相独立，可以并发运行'''
+
+    def __init__(self, path):
+        self.path = path
+        self.started_at = time.time()
+        self.listing = None  # 需要清理失效文件时，记录网盘目录树的遍历结果
+        self.created_dirs = set()  # 本次处理中已创建的目录，不再重复调用os.makedirs
+        self._lock = threading.Lock()
+        self.files = 0
+        self.strm_written = 0
+        self.strm_unchanged = 0
+        self.metadata_queued = 0
+        self.failures = []
+        self.cleanup = None
+        self.elapsed = None
+
+    def count(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def fail(self, file_path, error):
+        logger.error(f"处理文件失败: {file_path}，{error}")
+        with self._lock:
+            self.failures.append((file_path, str(error)))
+
+    def finish(self):
+        self.elapsed = time.time() - self.started_at
+        return self
+
+    @property
+    def throughput(self):
+        '''每秒处理的文件数'''
+        return round(self.files / self.elapsed, 1) if self.elapsed else None
+
+    def as_dict(self):
+        return {
+            'path': self.path,
+            'files': self.files,
+            'strm_written': self.strm_written,
+            'strm_unchanged': self.strm_unchanged,
+            'metadata_queued': self.metadata_queued,
+            'failures': list(self.failures),
+            'cleanup': self.cleanup,
+            'elapsed': round(self.elapsed, 3) if self.elapsed is not None else None,
+            'throughput': self.throughput,
+        }
+
+
 # refer to:
 # https://github.com/tanlidoushen/CloudDriveAlistEmbyScripts/blob/main/webhook_strm/sha1-strm-%E5%AE%8C%E6%95%B4%E8%B7%AF%E5%BE%84-url%E8%BD%AC%E7%A0%81.py
 class StrmProcessor:
-    def __init__(self, strm_config, fs) -> None:
+    def __init__(self, strm_config, storage_client, store=None) -> None:
         self.strm_cnf = strm_config
         self.max_workers = int(self.strm_cnf.get("max_workers", 1))
         self.video_exts = self.strm_cnf.get("video_exts", [])
@@ -46,9 +140,29 @@ class StrmProcessor:
         self.enable_clean_invalid_strm = self.strm_cnf.get("enable_clean_invalid_strm", False)
         self.enable_clean_invalid_folders = self.strm_cnf.get("enable_clean_invalid_folders", False)
         self.enable_clean_invalid_metadata = self.strm_cnf.get("enable_clean_invalid_metadata", False)
+        self.clean_dry_run = str2bool(self.strm_cnf.get("clean_dry_run", False))  # 只报告失效文件，不删除
         self.strm_root_mapping_rules = self.get_strm_root_mapping_rules()
-        self.generated_strm_files = set()
-        self.fs = fs
+        # 网盘路径 -> strm存储路径，网盘路径 -> 本地挂载路径；反向映射用于清理失效文件
+        self.dest_mapper = PathMapper([(src, dest) for src, dest, _ in self.strm_root_mapping_rules])
+        self.mount_mapper = PathMapper([(src, mount) for src, _, mount in self.strm_root_mapping_rules])
+        # 遍历网盘目录树与生成strm、处理元数据之间的队列长度上限，队列满时暂停遍历
+        self.queue_size = max(1, int(self.strm_cnf.get("queue_size", 1000)))
+        # 持久化的STRM文件清单，未变化的STRM文件无需打开读取
+        manifest_cnf = self.strm_cnf.get('manifest', {}) or {}
+        self.manifest = None
+        if store is not None and str2bool(manifest_cnf.get('enabled', True)):
+            self.manifest = StrmManifest(store, verify=str2bool(manifest_cnf.get('verify', False)))
+        # 经过FlaskStorageClientWrapper调用网盘接口，与目录遍历共用限流
+        self.storage_client = storage_client
+        # 元数据文件在独立的下载队列中下载，不阻塞strm文件的生成
+        download_cnf = self.strm_cnf.get('metadata_download', {}) or {}
+        self.download_queue = MetadataDownloadQueue(
+            storage_client,
+            max_workers=int(download_cnf.get('max_workers', 2)),
+            max_bandwidth=int(download_cnf.get('max_bandwidth', 0)),
+            max_pending=int(download_cnf.get('max_pending', 1000)),
+            priority_exts=download_cnf.get('priority_exts', ['.nfo', '.srt', '.ass', '.ssa', '.sup']),
+        )
         self.known_file_exts = self.video_exts + self.metadata_exts
 
     def get_strm_root_mapping_rules(self):
@@ -58,45 +172,68 @@ class StrmProcessor:
             rule_set.append((rule.get('src', ''), rule.get('dest', ''), rule.get('mount', '')))
         return rule_set
 
-    def process_file(self, file_path, src_root, dest_root, mount_root):
+    @staticmethod
+    def makedirs(directory, run):
+        if directory in run.created_dirs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        run.created_dirs.add(directory)
+
+    def process_file(self, file_path, size=None, run=None):
+        if run is None:
+            run = StrmRunResult(file_path)
         file_extension = os.path.splitext(file_path)[1].lower()
         # 获取strm文件/元数据文件的目标目录
-        target_path = os.path.dirname(file_path).replace(src_root, dest_root, 1)
+        target_path = self.dest_mapper.map(os.path.dirname(file_path))
+        if target_path is None:
+            logger.debug(f"{file_path}不在strm根目录映射范围内，跳过")
+            return False
         # 判断是strm文件还是元数据文件
         if file_extension in self.video_exts:
-            os.makedirs(target_path, exist_ok=True)
+            self.makedirs(target_path, run)
             strm_file_path = os.path.join(target_path, os.path.splitext(os.path.basename(file_path))[0] + '.strm')
             # 标准化路径
             strm_file_path = os.path.normpath(strm_file_path)
             # strm文件中的内容为本地挂载cd2后的路径
-            mount_file_path = file_path.replace(src_root, mount_root, 1)
+            mount_file_path = self.mount_mapper.map(file_path)
+
+            if self.manifest is not None and self.manifest.is_unchanged(strm_file_path, mount_file_path):
+                run.count('strm_unchanged')
+                return True  # "清单中的strm文件未变化，跳过生成"
 
             if os.path.exists(strm_file_path):
                 with open(strm_file_path, 'r', encoding='utf-8') as existing_strm:
                     existing_url = existing_strm.read().strip()
                 if existing_url == mount_file_path:
-                    self.generated_strm_files.add(strm_file_path)
+                    run.count('strm_unchanged')
+                    if self.manifest is not None:
+                        self.manifest.record(strm_file_path, mount_file_path)
                     return True  # "存在strm文件，跳过生成"
 
             with open(strm_file_path, 'w', encoding='utf-8') as strm_file:
                 strm_file.write(mount_file_path)
-                self.generated_strm_files.add(strm_file_path)
+                run.count('strm_written')
                 logger.info(f"生成.strm文件: {strm_file_path}")
+            if self.manifest is not None:
+                self.manifest.record(strm_file_path, mount_file_path)
             return True  # "已生成strm文件"
 
         elif self.enable_copy_metadata and file_extension in self.metadata_exts:
-            os.makedirs(target_path, exist_ok=True)
+            self.makedirs(target_path, run)
             target_file_path = os.path.join(target_path, os.path.basename(file_path))
             if not os.path.exists(target_file_path):
-                self.fs.download(file_path, target_file_path)
-                logger.info(f"复制文件: {file_path} -> {target_file_path}")
+                if self.download_queue.submit(file_path, os.path.normpath(target_file_path), size):
+                    run.count('metadata_queued')
                 return False  # "复制元数据文件"
 
-    def process_deleting_file(self, file_path, src_root, dest_root, mount_root):
+    def process_deleting_file(self, file_path):
         # logger.warning(f"处理文件: {file_path}")
         file_extension = os.path.splitext(file_path)[1].lower()
         # 获取strm文件/元数据文件的目标目录
-        target_path = os.path.dirname(file_path).replace(src_root, dest_root, 1)
+        target_path = self.dest_mapper.map(os.path.dirname(file_path))
+        if target_path is None:
+            logger.debug(f"{file_path}不在strm根目录映射范围内，跳过")
+            return False
         # 判断是strm文件还是元数据文件
         if file_extension in self.video_exts:
             os.makedirs(target_path, exist_ok=True)
@@ -104,211 +241,592 @@ class StrmProcessor:
             # 标准化路径
             strm_file_path = os.path.normpath(strm_file_path)
             os.remove(strm_file_path)
+            if self.manifest is not None:
+                self.manifest.forget(strm_file_path)
             return True  # "已生成strm文件"
 
         elif self.enable_copy_metadata and file_extension in self.metadata_exts:
             target_file_path = os.path.join(target_path, os.path.basename(file_path))
+            self.download_queue.cancel(os.path.normpath(target_file_path))
             if os.path.exists(target_file_path):
                 os.remove(target_file_path)
 
-    def cleanup_invalid_strm(self, net_folder, strm_folder):
-        logger.warning("开始清理失效的.strm文件...")
-        for root, _, files in os.walk(strm_folder):
+    def move(self, src_path, dest_path):
+        '''网盘中的文件（夹）被移动/重命名后，在本地移动对应的strm及元数据文件（夹），并改写strm文件中的挂载路径，
+        无需重新遍历网盘、下载元数据。本地无法完成（原路径不存在、新路径已存在等）时返回False，由调用方删除后重新生成
+        '''
+        if not (self.dest_mapper.matches(src_path) and self.dest_mapper.matches(dest_path)):
+            return False
+        old_local = os.path.normpath(self.dest_mapper.map(src_path))
+        new_local = os.path.normpath(self.dest_mapper.map(dest_path))
+        file_extension = os.path.splitext(src_path)[1].lower()
+        try:
+            if os.path.isdir(old_local):
+                if os.path.exists(new_local):
+                    return False
+                if self.manifest is not None:
+                    self.manifest.forget_dir(old_local)
+                os.makedirs(os.path.dirname(new_local), exist_ok=True)
+                shutil.move(old_local, new_local)
+                count = self.rewrite_strm_tree(
+                    new_local, self.mount_mapper.map(src_path), self.mount_mapper.map(dest_path)
+                )
+                logger.info(f"移动文件夹: {old_local} -> {new_local}，改写.strm文件{count}个")
+            elif file_extension in self.video_exts:
+                old_strm = os.path.splitext(old_local)[0] + '.strm'
+                new_strm = os.path.splitext(new_local)[0] + '.strm'
+                if not os.path.isfile(old_strm):
+                    return False
+                os.makedirs(os.path.dirname(new_strm), exist_ok=True)
+                mount_file_path = self.mount_mapper.map(dest_path)
+                with open(new_strm, 'w', encoding='utf-8') as strm_file:
+                    strm_file.write(mount_file_path)
+                if new_strm != old_strm:
+                    os.remove(old_strm)
+                if self.manifest is not None:
+                    self.manifest.forget(old_strm)
+                    self.manifest.record(new_strm, mount_file_path)
+                logger.info(f"移动.strm文件: {old_strm} -> {new_strm}")
+            elif file_extension in self.metadata_exts:
+                if not os.path.isfile(old_local):
+                    return False
+                self.download_queue.cancel(old_local)
+                os.makedirs(os.path.dirname(new_local), exist_ok=True)
+                os.replace(old_local, new_local)
+                logger.info(f"移动元数据文件: {old_local} -> {new_local}")
+            else:
+                return False
+        except OSError as e:
+            logger.error(f"本地移动失败: {old_local} -> {new_local}，{e}")
+            return False
+        finally:
+            if self.manifest is not None:
+                self.manifest.flush()
+        return True
+
+    def rewrite_strm_tree(self, folder, old_mount, new_mount):
+        '''将folder中strm文件内容里的挂载路径前缀old_mount替换为new_mount，返回改写的文件数'''
+        count = 0
+        for root, _, files in os.walk(folder):
             for file in files:
-                if file.endswith('.strm'):
-                    strm_file_path = os.path.normpath(os.path.join(root, file))
-                    _need_deleted = True
-                    if strm_file_path in self.generated_strm_files:  # 如果刚才已生产此strm文件
-                        _need_deleted = False
-                    else:  # 如果刚才没生成strm文件，但有可能其他线程监听时生成了该strm文件
-                        try:
-                            with open(strm_file_path, 'r', encoding='utf-8') as existing_strm:
-                                existing_url = existing_strm.read().strip()
-                                net_file_path = strm_file_path.replace(".strm", os.path.splitext(existing_url)[1], 1)
-                                net_file_path = net_file_path.replace(strm_folder, net_folder, 1)
-                                if self.fs.exists(net_file_path):
-                                    _need_deleted = False
-                        except Exception as e:
-                            logger.error(f"检测strm有效性失败！{e}")
-                            _need_deleted = False
-                    if _need_deleted:
-                        os.remove(strm_file_path)
-                        logger.info(f"删除失效的.strm文件: {strm_file_path}")
-
-    def cleanup_invalid_folders(self, src_folder, dest_folder):
-        logger.warning("开始清理失效的文件夹...")
-        for root, dirs, _ in os.walk(dest_folder, topdown=False):
+                if not file.endswith('.strm'):
+                    continue
+                strm_file_path = os.path.normpath(os.path.join(root, file))
+                with open(strm_file_path, 'r', encoding='utf-8') as existing_strm:
+                    content = existing_strm.read().strip()
+                if content == old_mount or content.startswith(old_mount.rstrip('/') + '/'):
+                    content = new_mount + content[len(old_mount) :]
+                    with open(strm_file_path, 'w', encoding='utf-8') as strm_file:
+                        strm_file.write(content)
+                    count += 1
+                if self.manifest is not None:
+                    self.manifest.record(strm_file_path, content)
+        return count
+
+    def expected_local_paths(self, listing):
+        '''根据网盘目录树的一次遍历结果，计算STRM目录中应当存在的strm文件、元数据文件及文件夹'''
+        strm_files, metadata_files = set(), set()
+        folders = {os.path.normpath(local) for local in map(self.dest_mapper.map, listing.dirs) if local is not None}
+        for file_path in listing.files:
+            target_path = self.dest_mapper.map(os.path.dirname(file_path))
+            if target_path is None:
+                continue
+            folders.add(os.path.normpath(target_path))
+            file_name = os.path.basename(file_path)
+            stem, file_extension = os.path.splitext(file_name)
+            if file_extension.lower() in self.video_exts:
+                strm_files.add(os.path.normpath(os.path.join(target_path, stem + '.strm')))
+            else:
+                metadata_files.add(os.path.normpath(os.path.join(target_path, file_name)))
+        return strm_files, metadata_files, folders
+
+    def scan_local(self, dest_folder, skipped=None):
+        '''一次遍历STRM目录，返回strm文件、元数据文件及文件夹；skipped（PathTrie）中的目录及其子目录不遍历'''
+        strm_files, metadata_files, folders = set(), set(), set()
+        dest_folder = os.path.normpath(dest_folder)
+        for root, dirs, files in os.walk(dest_folder):
+            if skipped:
+                dirs[:] = [d for d in dirs if skipped.longest_prefix(os.path.join(root, d))[0] is None]
             for _dir in dirs:
-                target_dir_path = os.path.normpath(os.path.join(root, _dir))
-                source_dir_path = target_dir_path.replace(dest_folder, src_folder, 1)
-                if not self.fs.exists(source_dir_path):
-                    shutil.rmtree(target_dir_path)
-                    logger.info(f"删除失效的文件夹: {target_dir_path}")
-
-    def cleanup_invalid_metadata(self, src_folder, dest_folder):
-        logger.warning("开始清理失效的元数据文件...")
-        for root, _, files in os.walk(dest_folder):
+                folders.add(os.path.normpath(os.path.join(root, _dir)))
             for file in files:
+                file_path = os.path.normpath(os.path.join(root, file))
                 file_extension = os.path.splitext(file)[1].lower()
-                if file_extension in self.metadata_exts:
-                    target_file_path = os.path.normpath(os.path.join(root, file))
-                    # 从strm路径映射回cd2中的路径
-                    source_file_path = target_file_path.replace(dest_folder, src_folder, 1)
-                    if not self.fs.exists(source_file_path):
-                        os.remove(target_file_path)
-                        logger.info(f"删除失效的元数据文件: {target_file_path}")
-
-    def clean_invalid(self, src_folder, dest_folder):
-        if self.enable_clean_invalid_strm:
-            self.cleanup_invalid_strm(src_folder, dest_folder)
+                if file_extension == '.strm':
+                    strm_files.add(file_path)
+                elif file_extension in self.metadata_exts:
+                    metadata_files.add(file_path)
+        return strm_files, metadata_files, folders
+
+    def reconcile(self, dest_folder, listing, started_at):
+        '''对比网盘目录树与STRM目录，以集合差计算失效的strm文件、元数据文件及文件夹，不再逐个请求网盘接口；
+        修改时间晚于started_at的文件（夹）可能是其他线程刚生成的，不会删除。dry_run时只报告，不删除
+        '''
+        report = {'dry_run': self.clean_dry_run, 'strm': [], 'metadata': [], 'folders': [], 'skipped_recent': 0}
+        if not os.path.isdir(dest_folder):
+            return report
+        skipped = PathTrie(
+            os.path.normpath(local) for local in map(self.dest_mapper.map, listing.skipped_dirs) if local is not None
+        )
+        expected_strm, expected_metadata, expected_folders = self.expected_local_paths(listing)
+        local_strm, local_metadata, local_folders = self.scan_local(dest_folder, skipped)
+
+        def is_recent(path):
+            try:
+                return os.stat(path).st_mtime >= started_at
+            except OSError:
+                return True
+
+        def collect(candidates):
+            stale = []
+            for path in sorted(candidates):
+                if is_recent(path):
+                    report['skipped_recent'] += 1
+                else:
+                    stale.append(path)
+            return stale
 
         if self.enable_clean_invalid_folders:
-            self.cleanup_invalid_folders(src_folder, dest_folder)
+            # 只删除最上层的失效文件夹，其中的文件随之删除
+            report['folders'] = sorted(PathTrie(collect(local_folders - expected_folders)).covering_set())
+        removed = PathTrie(report['folders'])
 
-        if self.enable_clean_invalid_metadata:
-            self.cleanup_invalid_metadata(src_folder, dest_folder)
+        def not_removed(paths):
+            return {p for p in paths if removed.longest_prefix(p)[0] is None}
 
-    def fs_walk_files(self, top: str, blacklist=[], **kwargs):
-        for _, dirs, files in self.fs.walk_attr(top, topdown=True, **kwargs):
+        if self.enable_clean_invalid_strm:
+            report['strm'] = collect(not_removed(local_strm - expected_strm))
+        if self.enable_clean_invalid_metadata:
+            report['metadata'] = collect(not_removed(local_metadata - expected_metadata))
+
+        if self.clean_dry_run:
+            for key, desc in (('strm', '.strm文件'), ('metadata', '元数据文件'), ('folders', '文件夹')):
+                for path in report[key]:
+                    logger.info(f"[试运行] 将删除失效的{desc}: {path}")
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self.remove_folder, p) for p in report['folders']]
+                futures += [executor.submit(self.remove_file, p, True) for p in report['strm']]
+                futures += [executor.submit(self.remove_file, p, False) for p in report['metadata']]
+                concurrent.futures.wait(futures)
+        logger.warning(
+            f"{'[试运行] ' if self.clean_dry_run else ''}清理失效文件：.strm文件{len(report['strm'])}个，"
+            f"元数据文件{len(report['metadata'])}个，文件夹{len(report['folders'])}个，"
+            f"跳过最近修改的{report['skipped_recent']}个"
+        )
+        return report
+
+    def remove_file(self, file_path, is_strm):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"删除失效文件失败: {file_path}，{e}")
+            return
+        if is_strm and self.manifest is not None:
+            self.manifest.forget(file_path)
+        logger.info(f"删除失效的{'.strm' if is_strm else '元数据'}文件: {file_path}")
+
+    def remove_folder(self, dir_path):
+        try:
+            if self.manifest is not None:
+                self.manifest.forget_dir(dir_path)
+            shutil.rmtree(dir_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"删除失效文件夹失败: {dir_path}，{e}")
+            return
+        logger.info(f"删除失效的文件夹: {dir_path}")
+
+    @property
+    def clean_enabled(self):
+        return self.enable_clean_invalid_strm or self.enable_clean_invalid_folders or self.enable_clean_invalid_metadata
+
+    def clean_invalid(self, dest_folder, listing, started_at):
+        if not self.clean_enabled:
+            return None
+        return self.reconcile(dest_folder, listing, started_at)
+
+    def fs_walk_files(self, top: str, blacklist=[], listing=None, **kwargs):
+        '''遍历网盘目录树，listing不为None时记录遍历到的文件、文件夹及跳过的文件夹，供清理失效文件时使用'''
+        if listing is not None:
+            listing.dirs.add(top)
+        # 生成strm及清理失效文件需要最新的目录树，不读取缓存
+        for _, dirs, files in self.storage_client.walk_attr(top, topdown=True, refresh=True, **kwargs):
             _dirs = [
                 d for d in dirs if not (d['path'] in blacklist or d['name'].startswith('.'))
             ]  # not valid when topdown=False
+            if listing is not None:
+                listing.dirs.update(d['path'] for d in _dirs)
+                listing.skipped_dirs.update(d['path'] for d in dirs if d['path'] not in listing.dirs)
+                listing.files.update(a['fullPathName'] for a in files)
+                listing.sizes.update((a['fullPathName'], a.get('size')) for a in files)
             dirs[:] = _dirs
-            yield [CloudDrivePath(self.fs, **a) for a in files]
-
-    def run(self, path, **kwargs):
+            yield [CloudDrivePath(self.storage_client.fs, **a) for a in files]
+
+    def run_pipeline(self, src_folder, run):
+        '''流水线：遍历网盘目录树 -> strm队列（max_workers个线程生成strm文件）/ 元数据队列（一个线程加入下载队列）；
+        队列有长度上限，处理不过来时遍历暂停，内存占用不随目录树的大小增长。单个文件的失败记录在run中，遍历失败时抛出异常
+        '''
+        strm_queue = queue.Queue(maxsize=self.queue_size)
+        metadata_queue = queue.Queue(maxsize=self.queue_size)
+        aborted = threading.Event()
+
+        def consume(q):
+            while True:
+                item = q.get()
+                if item is None:
+                    return
+                if aborted.is_set():
+                    continue
+                try:
+                    self.process_file(*item, run)
+                except Exception as e:
+                    run.fail(item[0], e)
+
+        strm_workers = [threading.Thread(target=consume, args=(strm_queue,), daemon=True) for _ in range(self.max_workers)]
+        metadata_worker = threading.Thread(target=consume, args=(metadata_queue,), daemon=True)
+        for worker in strm_workers + [metadata_worker]:
+            worker.start()
+        try:
+            for files in self.fs_walk_files(src_folder, listing=run.listing):
+                for file in files:
+                    file_path = file.fullPathName
+                    size = run.listing.sizes.pop(file_path, None) if run.listing is not None else None
+                    file_extension = os.path.splitext(file_path)[1].lower()
+                    run.files += 1
+                    if file_extension in self.video_exts:
+                        strm_queue.put((file_path, size))
+                    elif self.enable_copy_metadata and file_extension in self.metadata_exts:
+                        metadata_queue.put((file_path, size))
+        except BaseException:
+            aborted.set()
+            raise
+        finally:
+            for _ in strm_workers:
+                strm_queue.put(None)
+            metadata_queue.put(None)
+            for worker in strm_workers + [metadata_worker]:
+                worker.join()
+
+    def run(self, path, **kwargs) -> StrmRunResult:
         logger.warning(f"开始处理路径: {path}...")
-        self.generated_strm_files.clear()
+        run = StrmRunResult(path)
         # 从strm路径映射回cd2中的路径
         deleted = kwargs.get('deleted', False)
         src_folder = path
-        dest_folder = path
-        mount_folder = path
-        for rule in self.strm_root_mapping_rules:
-            if dest_folder.startswith(rule[0]):
-                dest_folder = dest_folder.replace(rule[0], rule[1], 1)
-                mount_folder = mount_folder.replace(rule[0], rule[2], 1)
-                break
+        dest_folder = self.dest_mapper.map(path)
+        if dest_folder is None:
+            logger.warning(f"{path}不在strm根目录映射范围内，跳过")
+            return run
+        if self.manifest is not None:
+            self.manifest.begin_run()
         # if not self.fs.attr(path)['isDirectory']:  # 如果是文件
         # FIXME: 通过splitext来粗略判断是否为文件夹，并不能百分百准确
         ext = os.path.splitext(path)[1]
-        if ext == '' or ext not in self.known_file_exts:  # 如果是文件夹
-            if deleted:
-                need_deleting_path = path.replace(src_folder, dest_folder, 1)
-                shutil.rmtree(need_deleting_path)
-                logger.info(f"清理失效路径：{need_deleting_path}")
-            else:
-                with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                    for files in self.fs_walk_files(src_folder):
-                        for file in files:
-                            file_path = file.fullPathName
-                            executor.submit(self.process_file, file_path, src_folder, dest_folder, mount_folder)
-            # 清理失效文件（夹）
-            self.clean_invalid(src_folder, dest_folder)
-        else:  # 如果是文件
-            src_folder = os.path.dirname(src_folder)
-            dest_folder = os.path.dirname(dest_folder)
-            mount_folder = os.path.dirname(mount_folder)
-            if deleted:
-                self.process_deleting_file(path, src_folder, dest_folder, mount_folder)
-            else:
-                self.process_file(path, src_folder, dest_folder, mount_folder)
-
-        logger.info("处理完成！")
+        try:
+            if ext == '' or ext not in self.known_file_exts:  # 如果是文件夹
+                if deleted:
+                    need_deleting_path = dest_folder
+                    if self.manifest is not None:
+                        self.manifest.forget_dir(need_deleting_path)
+                    shutil.rmtree(need_deleting_path)
+                    logger.info(f"清理失效路径：{need_deleting_path}")
+                else:
+                    # 生成strm时的网盘目录树遍历结果同时用于清理失效文件（夹）
+                    if self.clean_enabled:
+                        run.listing = SourceListing()
+                    self.run_pipeline(src_folder, run)
+                    # 清理失效文件（夹）
+                    run.cleanup = self.clean_invalid(dest_folder, run.listing, run.started_at)
+            else:  # 如果是文件
+                run.files = 1
+                try:
+                    if deleted:
+                        self.process_deleting_file(path)
+                    else:
+                        self.process_file(path, run=run)
+                except Exception as e:
+                    run.fail(path, e)
+        finally:
+            if self.manifest is not None:
+                self.manifest.flush()
+        run.finish()
+        download_stats = self.download_queue.stats()
+        if download_stats['pending']:
+            logger.info(f"元数据文件在后台下载，队列中还有{download_stats['pending']}个")
+        logger.info(
+            f"处理完成！文件{run.files}个，生成.strm文件{run.strm_written}个，未变化{run.strm_unchanged}个，"
+            f"元数据文件加入下载队列{run.metadata_queued}个，失败{len(run.failures)}个，"
+            f"耗时{run.elapsed:.1f}秒，{run.throughput}个/秒"
+        )
+        return run
+
+
+class LibraryCacheMixin(object):
+    '''媒体库信息的缓存：超过library_cache_ttl后在后台刷新，刷新期间继续使用旧的媒体库信息；
+    从未成功获取或被invalidate_libraries后，在下一次扫描前同步刷新。子类实现refresh_libraries，成功时返回True
+    '''
+
+    def init_library_cache(self):
+        self.library_cache_ttl = timeparse(str(self.server_cnf.get('library_cache_ttl', '1h')))
+        self.libraries_loaded_at = 0
+        self.libraries_invalid = True
+        self._library_lock = threading.Lock()
+
+    def refresh_libraries(self) -> bool:
+        raise NotImplementedError
+
+    def load_libraries(self):
+        if self.refresh_libraries():
+            self.libraries_loaded_at = time.time()
+            self.libraries_invalid = False
+
+    def _background_load_libraries(self):
+        try:
+            self.load_libraries()
+        finally:
+            self._library_lock.release()
+
+    def ensure_libraries(self):
+        if self.libraries_invalid:
+            with self._library_lock:
+                if self.libraries_invalid:
+                    self.load_libraries()
+            return
+        if time.time() - self.libraries_loaded_at > self.library_cache_ttl and self._library_lock.acquire(
+            blocking=False
+        ):
+            threading.Thread(target=self._background_load_libraries, daemon=True).start()
+
+    def invalidate_libraries(self):
+        self.libraries_invalid = True
+
+    def library_cache_stats(self):
+        return {
+            'server_type': self.server_type,
+            'host': self.server_cnf['host'],
+            'locations': len(self.library_index.trie),
+            'loaded_at': self.libraries_loaded_at or None,
+            'invalid': self.libraries_invalid,
+        }
+
+
+class BackpressureMixin(object):
+    '''分发扫描请求前检查媒体服务器的负载：正在执行的媒体库扫描/刷新任务数达到max_active_tasks时推迟分发，
+    每poll_interval秒检查一次，单次分发最多推迟max_deferral秒，超时后仍然发送，保证变更在有限时间内送达。
+    子类实现server_load，返回(正在执行的任务数, 描述)
+    '''
+
+    def init_backpressure(self):
+        backpressure_cnf = self.server_cnf.get('backpressure', {}) or {}
+        self.backpressure_enabled = str2bool(backpressure_cnf.get('enabled', False))
+        self.max_active_tasks = max(1, int(backpressure_cnf.get('max_active_tasks', 1)))
+        self.load_poll_interval = timeparse(str(backpressure_cnf.get('poll_interval', '10s')))
+        self.max_deferral = timeparse(str(backpressure_cnf.get('max_deferral', '10m')))
+        self.load_checked_at = 0
+        self.deferrals = 0
+        self.deferred_seconds = 0.0
+        self.forced_dispatches = 0
+
+    def server_load(self):
+        raise NotImplementedError
+
+    def is_saturated(self):
+        try:
+            active, detail = self.server_load()
+        except Exception as e:
+            # 无法获取负载时不阻塞分发
+            logger.debug(f"Failed to get the load of {self.server_type}!\n{e}")
+            return False, ""
+        return active >= self.max_active_tasks, detail
+
+    def wait_for_capacity(self, deadline):
+        '''服务器繁忙时等待，直到空闲或到达deadline'''
+        if not self.backpressure_enabled or time.time() - self.load_checked_at < self.load_poll_interval:
+            return
+        start = time.time()
+        deferred = False
+        while True:
+            saturated, detail = self.is_saturated()
+            self.load_checked_at = time.time()
+            if not saturated:
+                break
+            if time.time() >= deadline:
+                self.forced_dispatches += 1
+                logger.warning(f"[{self.server_type}]媒体服务器仍然繁忙（{detail}），已达到最长推迟时间，继续发送扫描请求")
+                break
+            if not deferred:
+                deferred = True
+                self.deferrals += 1
+                logger.warning(f"[{self.server_type}]媒体服务器繁忙（{detail}），推迟发送扫描请求...")
+            time.sleep(max(0, min(self.load_poll_interval, deadline - time.time())))
+        if deferred:
+            self.deferred_seconds += time.time() - start
+
+    def backpressure_stats(self):
+        return {
+            'backpressure_enabled': self.backpressure_enabled,
+            'deferrals': self.deferrals,
+            'deferred_seconds': round(self.deferred_seconds, 1),
+            'forced_dispatches': self.forced_dispatches,
+        }
 
 
 # refer to:
 # https://github.com/jxxghp/MoviePilot/blob/19165eff759f14e9947e772c574f9775b388df0e/app/modules/plex/plex.py#L355
-class PlexScanner:
+class PlexScanner(LibraryCacheMixin, BackpressureMixin):
     def __init__(self, config) -> None:
         self.server_type = 'plex'
         # self.server_cnf = config[self.server_type]
         self.server_cnf = config
-        try:
-            self.pms = PlexServer(self.server_cnf["host"], self.server_cnf["token"])
-            self._libraies = self.pms.library.sections()
-        except Exception as e:
-            logger.error(f"[PLEX] Failed to connect to the Plex Media Server!\n{e}")
-        self.path_mapping_rules = get_path_mapping_rules(self.server_cnf)
+        self.client = get_media_client(self.server_type, self.server_cnf)
+        self.pms = None
+        self._libraies = []
+        self.library_index = LibraryIndex()
+        self.init_library_cache()
+        self.load_libraries()
+        self.path_mapper = PathMapper(get_path_mapping_rules(self.server_cnf), passthrough=True)
         self.isfile_based_scanning = self.server_cnf.get('isfile_based_scanning', True)
+        # 同一目录下超过该数量的路径需要刷新时，改为刷新该目录，0表示不合并到父目录
+        self.collapse_siblings_threshold = int(self.server_cnf.get('collapse_siblings_threshold', 0))
+        # 两次刷新之间的最短间隔（秒）
+        self.scan_interval = float(self.server_cnf.get('scan_interval', 1))
+        self.last_request_at = 0
+        self.init_backpressure()
 
     def reconnect(self):
         try:
-            self.pms = PlexServer(self.server_cnf["host"], self.server_cnf["token"])
-            self._libraies = self.pms.library.sections()
+            self.pms = self.client.call(
+                PlexServer,
+                self.server_cnf["host"],
+                self.server_cnf["token"],
+                session=self.client.session,
+                timeout=self.client.timeout[1],
+            )
+            self._libraies = self.client.call(self.pms.library.sections)
         except Exception as e:
             logger.error(f"[PLEX] Failed to connect to the Plex Media Server!\n{e}")
-
-    def find_library_by_path(self, path: Path) -> str:
+            return False
+        library_index = LibraryIndex()
+        for lib in self._libraies:
+            if hasattr(lib, "locations") and lib.locations:
+                for location in lib.locations:
+                    library_index.add(location, lib.key)
+        self.library_index = library_index
+        return True
+
+    def refresh_libraries(self) -> bool:
+        return self.reconnect()
+
+    def server_load(self):
+        '''正在执行的媒体库相关活动（扫描、刷新、分析等）'''
+        activities = self.client.call(self.pms.query, '/activities')
+        types = [a.attrib.get('type', '') for a in activities.iter('Activity')]
+        library_types = [t for t in types if t.startswith('library.')]
+        return len(library_types), ", ".join(library_types)
+
+    def find_library_by_path(self, path: str) -> str:
         """
         Determine which media this path belongs to.
         """
-
         if path is None:
             return ""
+        return self.library_index.lookup(path)
+
+    def map_path(self, path: str) -> str:
+        return self.path_mapper.map(path)
+
+    def refresh_section(self, lib_key, path: str, deadline=None) -> bool:
+        '''刷新媒体库lib_key中的路径path，两次刷新之间至少间隔scan_interval秒'''
+        if deadline is not None:
+            self.wait_for_capacity(deadline)
+        if self.scan_interval > 0:
+            wait = self.last_request_at + self.scan_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        self.last_request_at = time.time()
         try:
-            for lib in self._libraies:
-                if hasattr(lib, "locations") and lib.locations:
-                    for location in lib.locations:
-                        if is_subpath(path, Path(location)):
-                            if path.is_file():
-                                # plex media server only supports refreshing folders not files
-                                # path = path.parent
-                                pass
-                            # return lib.key, lib.title, str(path)
-                            return lib.key
-        except Exception as err:
-            logger.error(f"[PLEX] Unable to find a library for the path[{path.as_posix()}]\n{err}")
-        return ""
-
-    # def plex_scan_specific_path(self, plex_libraies, directory):
-    def scan_path(self, path: str, **kwargs) -> bool:
-        for rule in self.path_mapping_rules:
-            if path.startswith(rule[0]):
-                path = path.replace(rule[0], rule[1], 1)
-                break
-        try:
-            lib_key = self.find_library_by_path(Path(path))
-            if not bool(lib_key):
-                logger.error(f"路径[{path}]未被包含在何媒体库的子目录中!")
-                return False
-            if bool(lib_key) and bool(path):
-                # logger.info(f"[PLEX] Scanning the library[{lib_title}] - path[{path}]")
-                self.pms.query(f"/library/sections/{lib_key}/refresh?path={quote_plus(Path(path).as_posix())}")
-                time.sleep(1)
-                logger.warning(f"- {path}")
-                return True
-            else:
-                logger.error(f"[PLEX] Unable to find a library for the path[{path}]!")
-                return False
+            # logger.info(f"[PLEX] Scanning the library[{lib_title}] - path[{path}]")
+            self.client.call(
+                self.pms.query, f"/library/sections/{lib_key}/refresh?path={quote_plus(Path(path).as_posix())}"
+            )
+            logger.warning(f"- {path}")
+            return True
         except Exception as e:
             logger.error(f"[PLEX] Failed to scan the path[{path}]!\n{e}")
             return False
 
+    def scan_paths(self, paths, **kwargs) -> dict:
+        '''按媒体库将路径合并为最少的不相互包含的目录后刷新，返回路径 -> 是否扫描成功'''
+        self.ensure_libraries()
+        deadline = time.time() + self.max_deferral
+        results = {}
+        section_paths = defaultdict(lambda: defaultdict(list))
+        for path in paths:
+            mapped = self.map_path(path)
+            lib_key = self.find_library_by_path(mapped)
+            if not bool(lib_key):
+                logger.error(f"路径[{mapped}]未被包含在何媒体库的子目录中!")
+                results[path] = False
+                continue
+            section_paths[lib_key][mapped].append(path)
+        for lib_key, mapped2paths in section_paths.items():
+            covers = coalesce_paths(
+                mapped2paths.keys(),
+                collapse_threshold=self.collapse_siblings_threshold,
+                can_collapse=lambda p, k=lib_key: self.find_library_by_path(p) == k,
+            )
+            refreshed = {}
+            for mapped, origin_paths in mapped2paths.items():
+                cover = covers[mapped]
+                if cover not in refreshed:
+                    refreshed[cover] = self.refresh_section(lib_key, cover, deadline)
+                for p in origin_paths:
+                    results[p] = refreshed[cover]
+            if len(refreshed) < len(mapped2paths):
+                logger.info(f"[PLEX] 媒体库[{lib_key}]的{len(mapped2paths)}个路径合并为{len(refreshed)}次刷新")
+        return results
+
+    def scan_path(self, path: str, **kwargs) -> bool:
+        return self.scan_paths([path], **kwargs)[path]
+
 
 # refer to:
 # https://github.com/NiNiyas/autoscan/blob/master/jelly_emby.py#L88
 # https://github.com/jxxghp/MoviePilot/blob/19165eff759f14e9947e772c574f9775b388df0e/app/modules/emby/emby.py
-class EmbyScanner:
-    def __init__(self, config) -> None:
-        self.server_type = 'emby'
+class EmbyScanner(LibraryCacheMixin, BackpressureMixin):
+    def __init__(self, config, server_type='emby') -> None:
+        self.server_type = server_type
         # self.server_cnf = config[self.server_type]
         self.server_cnf = config
         self.host = self.server_cnf['host']
         self.api_key = self.server_cnf['api_key']
-        self.path_mapping_rules = get_path_mapping_rules(self.server_cnf)
+        self.client = get_media_client(self.server_type, self.server_cnf)
+        self.path_mapper = PathMapper(get_path_mapping_rules(self.server_cnf), passthrough=True)
         self.isfile_based_scanning = self.server_cnf.get('isfile_based_scanning', True)
+        # 每次请求通知更新的路径数，及两次请求之间的最短间隔（秒）
+        self.batch_size = max(1, int(self.server_cnf.get('batch_size', 50)))
+        self.batch_interval = float(self.server_cnf.get('batch_interval', 0))
+        self.last_request_at = 0
+        self.init_backpressure()
         # 获取所有媒体文件夹
         self.library_folders_map = {}
         self.folders_library_map = {}
         self.library_all_folders = []
-        self.get_libraries()
+        self.library_index = LibraryIndex()
+        self.init_library_cache()
+        self.load_libraries()
 
     def get_libraries(self):
+        library_folders_map = {}
+        folders_library_map = {}
+        library_all_folders = []
+        library_index = LibraryIndex()
         try:
-            response = requests.get(
-                self.host + f'/Library/SelectableMediaFolders?api_key={self.api_key}',
-            )
+            response = self.client.get(f'/Library/SelectableMediaFolders?api_key={self.api_key}')
             data = response.json()
             # self.folders = response.json()
             for library_meta in data:
@@ -317,82 +835,176 @@ class EmbyScanner:
                 sub_folders = []
                 for _sub in raw_sub_folders:
                     sub_folders.append(_sub['Path'])
-                    self.folders_library_map[_sub['Path']] = library_name
+                    folders_library_map[_sub['Path']] = library_name
+                    library_index.add(_sub['Path'], library_name)
 
-                self.library_folders_map[library_name] = sub_folders
-                self.library_all_folders.extend(sub_folders)
+                library_folders_map[library_name] = sub_folders
+                library_all_folders.extend(sub_folders)
         except RequestException as e:
             logger.error(f"Failed to get libraries from {self.server_type}!\n{e}")
-
-    def find_library_by_path(self, path: Path) -> str:
+            return False
+        self.library_folders_map = library_folders_map
+        self.folders_library_map = folders_library_map
+        self.library_all_folders = library_all_folders
+        self.library_index = library_index
+        return True
+
+    def refresh_libraries(self) -> bool:
+        return self.get_libraries()
+
+    def server_load(self):
+        '''正在运行的媒体库计划任务（扫描媒体库等）及正在刷新的媒体库'''
+        tasks = self.client.get(f'/ScheduledTasks?api_key={self.api_key}').json()
+        running = [t['Name'] for t in tasks if t.get('Category') == 'Library' and t.get('State') == 'Running']
+        folders = self.client.get(f'/Library/VirtualFolders?api_key={self.api_key}').json()
+        refreshing = [f['Name'] for f in folders if f.get('RefreshStatus') not in (None, 'Idle')]
+        return len(running) + len(refreshing), ", ".join(running + refreshing)
+
+    def find_library_by_path(self, path: str) -> str:
         if path is None:
             return ""
-        for lib_sub_path in self.library_all_folders:
-            if is_subpath(path, Path(lib_sub_path)):
-                return self.folders_library_map[lib_sub_path]
-        return ""
-
-    def scan_path(self, path: str, **kwargs) -> bool:
-        for rule in self.path_mapping_rules:
-            if path.startswith(rule[0]):
-                path = path.replace(rule[0], rule[1], 1)
-                break
-        data = {"Updates": [{"Path": f"{path}", "UpdateType": "Created"}]}
+        return self.library_index.lookup(path)
+
+    def map_path(self, path: str) -> str:
+        return self.path_mapper.map(path)
+
+    def wait_for_pacing(self):
+        '''两次请求之间至少间隔batch_interval秒'''
+        if self.batch_interval > 0:
+            wait = self.last_request_at + self.batch_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        self.last_request_at = time.time()
+
+    def post_updates(self, paths, update_types=None) -> bool:
+        '''通过一次/Library/Media/Updated请求通知emby更新多个路径，update_types为路径 -> 更新类型，默认为Created'''
+        update_types = update_types or {}
+        data = {"Updates": [{"Path": f"{p}", "UpdateType": update_types.get(p, "Created")} for p in paths]}
         headers = {"accept": "application/json", "Content-Type": "application/json"}
+        self.wait_for_pacing()
+        command = self.client.post(
+            f'/Library/Media/Updated?api_key={self.api_key}',
+            headers=headers,
+            json=data,
+        )
+        if command.status_code == 204:
+            return True
+        logger.error(f"Failed to refresh {len(paths)} path(s) on {self.server_type}! [{command.status_code}]")
+        return False
+
+    def scan_batch(self, batch, results, deadline=None, update_types=None):
+        '''发送一批路径，失败时二分重试，直到能够确定失败的单个路径；emby无法连接时整批失败，不再二分'''
+        if deadline is not None:
+            self.wait_for_capacity(deadline)
         try:
-            lib_name = self.find_library_by_path(Path(path))
-            if not bool(lib_name):
-                logger.error(f"路径[{path}]未被包含在何媒体库的子目录中!")
-                return False
-            command = requests.post(
-                self.host + f'/Library/Media/Updated?api_key={self.api_key}',
-                headers=headers,
-                json=data,
-            )
-            time.sleep(1)
-            if command.status_code == 204:
-                logger.warning(f"- {path}")
-                return True
-            else:
-                logger.error(f"Failed to scan the path[{path}]!")
-                return False
+            succeeded = self.post_updates([mapped for _, mapped in batch], update_types)
         except RequestException as e:
-            logger.error(f"Failed to refresh the path[{path}]!\n{e}")
-            # raise RequestException(f"Error occurred when trying to send scan request to {self.server_type}. {e}")
-            return False
+            logger.error(f"Failed to refresh {len(batch)} path(s) on {self.server_type}!\n{e}")
+            for path, _ in batch:
+                results[path] = False
+            return
+        if succeeded:
+            for path, mapped in batch:
+                results[path] = True
+                logger.warning(f"- {mapped}")
+            return
+        if len(batch) == 1:
+            path, mapped = batch[0]
+            results[path] = False
+            logger.error(f"Failed to scan the path[{mapped}]!")
+            return
+        middle = len(batch) // 2
+        self.scan_batch(batch[:middle], results, deadline, update_types)
+        self.scan_batch(batch[middle:], results, deadline, update_types)
+
+    def scan_paths(self, paths, **kwargs) -> dict:
+        '''按batch_size分批通知emby更新路径，返回路径 -> 是否扫描成功；deleted_paths中的路径以Deleted类型通知'''
+        self.ensure_libraries()
+        deleted_paths = kwargs.get('deleted_paths') or ()
+        results = {}
+        pending = []
+        for path in paths:
+            mapped = self.map_path(path)
+            if not bool(self.find_library_by_path(mapped)):
+                logger.error(f"路径[{mapped}]未被包含在何媒体库的子目录中!")
+                results[path] = False
+                continue
+            pending.append((path, mapped))
+        update_types = {mapped: "Deleted" for path, mapped in pending if path in deleted_paths}
+        deadline = time.time() + self.max_deferral
+        for i in range(0, len(pending), self.batch_size):
+            self.scan_batch(pending[i : i + self.batch_size], results, deadline, update_types)
+        return results
 
+    def scan_path(self, path: str, **kwargs) -> bool:
+        return self.scan_paths([path], **kwargs)[path]
 
-class EmbyStrmScanner(EmbyScanner):
-    def __init__(self, config, fs) -> None:
-        super().__init__(config)
-        self.server_type = 'embystrm'
-        self.strm_processor = StrmProcessor(config['strm'], fs)
 
-    def scan_path(self, path: str, **kwargs) -> bool:
-        self.strm_processor.run(path, **kwargs)
-        for rule in self.path_mapping_rules:
-            if path.startswith(rule[0]):
-                path = path.replace(rule[0], rule[1], 1)
-                break
-        data = {"Updates": [{"Path": f"{path}", "UpdateType": "Created"}]}
-        headers = {"accept": "application/json", "Content-Type": "application/json"}
-        try:
-            lib_name = self.find_library_by_path(Path(path))
-            if not bool(lib_name):
-                logger.error(f"路径[{path}]未被包含在何媒体库的子目录中!")
-                return False
-            command = requests.post(
-                self.host + f'/Library/Media/Updated?api_key={self.api_key}',
-                headers=headers,
-                json=data,
-            )
-            time.sleep(1)
-            if command.status_code == 204:
-                logger.warning(f"- {path}")
-                return True
-            else:
-                logger.error(f"Failed to scan the path[{path}]!")
-                return False
-        except RequestException as e:
-            logger.error(f"Failed to refresh the path[{path}]!\n{e}")
-            return False
+class EmbyStrmScanner(EmbyScanner):
+    def __init__(self, config, storage_client, store=None) -> None:
+        super().__init__(config, server_type='embystrm')
+        self.strm_processor = StrmProcessor(config['strm'], storage_client, store)
+
+    def scan_paths(self, paths, **kwargs) -> dict:
+        # strm_handled: strm文件已在本地处理（如移动/重命名），只通知emby
+        for path in [] if kwargs.get('strm_handled') else paths:
+            result = self.strm_processor.run(path, **kwargs)
+            if result.failures:
+                logger.error(f"[{self.server_type}] {path} 中有{len(result.failures)}个文件生成strm失败")
+        return super().scan_paths(paths, **kwargs)
+
+
+class ScannerRegistry(object):
+    '''进程内共享的扫描器：按服务器配置复用，保持与媒体服务器的连接及缓存的媒体库信息，
+    避免每次定时遍历、手动扫描、文件变更通知都重新连接媒体服务器并获取媒体库
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scanners = {}
+
+    def get_scanners(self, servers_cfg, storage_client, store=None):
+        scanners = []
+        for server_type in ('plex', 'emby', 'embystrm'):
+            server_cnf = servers_cfg.get(server_type)
+            if not server_cnf or not str2bool(server_cnf.get('enabled', False)):
+                continue
+            key = (server_type, json.dumps(server_cnf, sort_keys=True, default=str))
+            with self._lock:
+                scanner = self._scanners.get(key)
+            if scanner is None:
+                # 创建扫描器时会连接媒体服务器并获取媒体库，不能持有锁，否则一个服务器缓慢时阻塞所有扫描及状态查询
+                if server_type == 'plex':
+                    scanner = PlexScanner(server_cnf)
+                elif server_type == 'emby':
+                    scanner = EmbyScanner(server_cnf)
+                else:
+                    scanner = EmbyStrmScanner(server_cnf, storage_client, store)
+                with self._lock:
+                    # 其他线程已创建同一配置的扫描器时使用已有的
+                    existing = self._scanners.get(key)
+                    if existing is not None:
+                        scanner = existing
+                    else:
+                        # 配置变更后旧的扫描器不再使用
+                        for _key in [k for k in self._scanners if k[0] == server_type]:
+                            self._scanners.pop(_key)
+                        self._scanners[key] = scanner
+            scanners.append(scanner)
+        return scanners
+
+    def invalidate(self, server_type=None):
+        '''使媒体库缓存失效，下一次扫描前重新获取，返回受影响的扫描器数量'''
+        with self._lock:
+            scanners = [v for k, v in self._scanners.items() if server_type is None or k[0] == server_type]
+        for scanner in scanners:
+            scanner.invalidate_libraries()
+        return len(scanners)
+
+    def stats(self):
+        with self._lock:
+            scanners = list(self._scanners.values())
+        return [dict(scanner.library_cache_stats(), **scanner.backpressure_stats()) for scanner in scanners]
+
+
+scanner_registry = ScannerRegistry()
@@ -0,0 +1,128 @@
+import json
+import hashlib
+from .logger import getLogger
+from .path_trie import paths_overlap
+
+logger = getLogger(__name__)
+
+
+class DirectorySnapshot(object):
+    '''监控目录树的持久化快照，保存在redis中，重启后依然有效：
+    {KEY_PREFIX}:{root} 哈希表，目录 -> "mtime|listing指纹"，用于判断子树是否未变更；
+    {KEY_PREFIX}:{root}:children 哈希表，目录 -> 子文件（夹）名到mtime的json，用于找出变更的子文件（夹）。
+    快照只在目录的mtime写库（即扫描成功）时一并写入，因此快照与数据库中的mtime保持一致。
+    '''
+
+    KEY_PREFIX = 'snapshot'
+
+    def __init__(self, store, root, storage_client):
+        self.store = store
+        self.root = root
+        self.storage_client = storage_client
+        self.index_key = f"{self.KEY_PREFIX}:{root}"
+        self.children_key = f"{self.KEY_PREFIX}:{root}:children"
+        self.index = {}
+        self.staged = {}
+        self.unchanged = {}  # 目录 -> 本次遍历中的listing是否与快照一致，同一目录的各子目录共用
+
+    def load(self):
+        '''一次性读入目录 -> (mtime, 指纹)的索引，用于遍历时剪枝'''
+        self.index.clear()
+        self.unchanged.clear()
+        cursor = 0
+        while True:
+            self.store.count_round_trip()
+            cursor, data = self.store.db.hscan(self.index_key, cursor, count=self.store.batch_size)
+            for path, value in data.items():
+                mtime, _, fp = value.partition('|')
+                self.index[path] = (mtime, fp)
+            if cursor == 0:
+                break
+        return len(self.index)
+
+    def listing_children(self, subs):
+        return {a['name']: self.storage_client.attr_mtime(a) for a in subs}
+
+    @staticmethod
+    def fingerprint(children):
+        return hashlib.sha1(json.dumps(sorted(children.items()), ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def should_descend(self, dir_attr, subs, child_attr):
+        '''父目录的listing及子目录的mtime均与快照一致时，跳过该子目录的整个子树'''
+        child = self.index.get(child_attr['path'])
+        if child is None or child[0] != self.storage_client.attr_mtime(child_attr):
+            return True
+        return not self.is_unchanged(dir_attr, subs)
+
+    def is_unchanged(self, dir_attr, subs):
+        '''目录的mtime及listing与快照一致，结果按目录缓存，指纹只计算一次'''
+        path = dir_attr['path']
+        unchanged = self.unchanged.get(path)
+        if unchanged is None:
+            parent = self.index.get(path)
+            unchanged = parent is not None and parent == (
+                self.storage_client.attr_mtime(dir_attr),
+                self.fingerprint(self.listing_children(subs)),
+            )
+            self.unchanged[path] = unchanged
+        return unchanged
+
+    def stage(self, dir_attr, subs):
+        '''暂存目录当前的listing，等待commit时写入'''
+        self.staged[dir_attr['path']] = (self.storage_client.attr_mtime(dir_attr), self.listing_children(subs))
+
+    def discard_staged(self, paths):
+        '''丢弃与快照一致的目录的暂存listing，不再写入'''
+        for p in paths:
+            self.staged.pop(p, None)
+
+    def dump_staged(self):
+        return {p: [mtime, children] for p, (mtime, children) in self.staged.items()}
+
+    def load_staged(self, staged):
+        for p, (mtime, children) in staged.items():
+            self.staged[p] = (mtime, children)
+
+    def get_children_many(self, paths):
+        '''批量读取目录在快照中的子文件（夹）名到mtime的映射，不存在时为None'''
+        paths = list(paths)
+        result = {}
+        for i in range(0, len(paths), self.store.batch_size):
+            chunk = paths[i : i + self.store.batch_size]
+            self.store.count_round_trip()
+            for path, value in zip(chunk, self.store.db.hmget(self.children_key, chunk)):
+                result[path] = json.loads(value) if value else None
+        return result
+
+    def commit(self, paths):
+        '''将暂存的listing写入快照'''
+        items = [(p, self.staged.pop(p)) for p in paths if p in self.staged]
+        for i in range(0, len(items), self.store.batch_size):
+            chunk = items[i : i + self.store.batch_size]
+            self.store.count_round_trip()
+            pipe = self.store.db.pipeline(transaction=False)
+            for path, (mtime, children) in chunk:
+                fp = self.fingerprint(children)
+                pipe.hset(self.index_key, path, f"{mtime}|{fp}")
+                pipe.hset(self.children_key, path, json.dumps(children, ensure_ascii=False))
+                self.index[path] = (mtime, fp)
+                self.unchanged.pop(path, None)
+            pipe.execute()
+
+    def discard(self):
+        self.store.count_round_trip()
+        self.store.db.delete(self.index_key, self.children_key)
+        self.index.clear()
+        self.unchanged.clear()
+        self.staged.clear()
+
+    @classmethod
+    def discard_overlapping(cls, store, folder):
+        '''丢弃与folder有重叠的监控目录的快照，下一次遍历时会完整遍历并重建快照'''
+        for key in store.db.scan_iter(match=f"{cls.KEY_PREFIX}:*"):
+            if key.endswith(':children'):
+                continue
+            root = key[len(cls.KEY_PREFIX) + 1 :]
+            if paths_overlap(root, folder):
+                store.db.delete(key, f"{key}:children")
+                logger.info(f"已丢弃目录[{root}]的快照")
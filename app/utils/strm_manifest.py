@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import threading
+from .logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class StrmManifest(object):
+    '''STRM文件清单，保存在redis中，按STRM文件所在目录分桶：{KEY_PREFIX}:{hash(目录)} 哈希表，
+    字段为文件名，值为json [strm内容(挂载路径), st_mtime_ns, st_size]。
+    清单中的内容与期望一致且文件的stat未变化时，无需打开读取STRM文件即可跳过；
+    verify模式下总是读取文件内容比较，并刷新清单。每次处理开始时调用begin_run清空内存中缓存的清单。
+    '''
+
+    KEY_PREFIX = 'strmmanifest'
+
+    def __init__(self, store, verify=False):
+        self.store = store
+        self.verify = verify
+        self._lock = threading.Lock()
+        self.buckets = {}
+        self.pending = {}
+        self.hits = 0
+
+    @classmethod
+    def bucket_key(cls, directory):
+        return f"{cls.KEY_PREFIX}:{hashlib.blake2b(directory.encode('utf-8'), digest_size=12).hexdigest()}"
+
+    def begin_run(self):
+        with self._lock:
+            self.buckets.clear()
+
+    def _bucket(self, directory):
+        bucket = self.buckets.get(directory)
+        if bucket is None:
+            self.store.count_round_trip()
+            bucket = {k: json.loads(v) for k, v in self.store.db.hgetall(self.bucket_key(directory)).items()}
+            with self._lock:
+                bucket = self.buckets.setdefault(directory, bucket)
+        return bucket
+
+    @staticmethod
+    def stat_of(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def is_unchanged(self, strm_path, content):
+        '''清单中记录的内容与content一致，且文件的stat与记录一致'''
+        if self.verify:
+            return False
+        directory, name = os.path.split(strm_path)
+        entry = self._bucket(directory).get(name)
+        if entry is None or entry[0] != content:
+            return False
+        if self.stat_of(strm_path) != (entry[1], entry[2]):
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def record(self, strm_path, content):
+        '''记录已写入/已校验的STRM文件'''
+        stat = self.stat_of(strm_path)
+        if stat is None:
+            return
+        directory, name = os.path.split(strm_path)
+        entry = [content, stat[0], stat[1]]
+        with self._lock:
+            if directory in self.buckets:
+                self.buckets[directory][name] = entry
+        self._stage(directory, name, json.dumps(entry, ensure_ascii=False))
+
+    def forget(self, strm_path):
+        directory, name = os.path.split(strm_path)
+        with self._lock:
+            if directory in self.buckets:
+                self.buckets[directory].pop(name, None)
+        self._stage(directory, name, None)
+
+    def _stage(self, directory, name, value):
+        '''暂存待写入的记录，达到batch_size时批量写入'''
+        with self._lock:
+            self.pending.setdefault(directory, {})[name] = value
+            should_flush = sum(len(v) for v in self.pending.values()) >= self.store.batch_size
+        if should_flush:
+            self.flush()
+
+    def forget_dir(self, directory):
+        '''删除目录及其子目录下所有STRM文件的记录，需在删除目录之前调用'''
+        directories = [directory] + [root for root, _, _ in os.walk(directory)][1:]
+        with self._lock:
+            for d in directories:
+                self.buckets.pop(d, None)
+                self.pending.pop(d, None)
+        self.store.count_round_trip()
+        self.store.db.delete(*[self.bucket_key(d) for d in directories])
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        self.store.count_round_trip()
+        pipe = self.store.db.pipeline(transaction=False)
+        for directory, entries in pending.items():
+            key = self.bucket_key(directory)
+            updated = {k: v for k, v in entries.items() if v is not None}
+            deleted = [k for k, v in entries.items() if v is None]
+            if updated:
+                pipe.hset(key, mapping=updated)
+            if deleted:
+                pipe.hdel(key, *deleted)
+        pipe.execute()
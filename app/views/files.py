@@ -1,7 +1,7 @@
 import os
 from flask import render_template, request, Blueprint, jsonify, abort, current_app
 from flask_login import login_required
-from app.extensions import storage_client, redis_db
+from app.extensions import storage_client, mtime_store
 from app.utils import getLogger, sort_list_mixedversion, timestamp_to_datetime, MtimeUpdateStrategySchema
 from app.tasks import mtime_updating, mtime_clearing
 
@@ -38,11 +38,11 @@ def files(req_path):
     _adjuster = len(str(len(sorted_names)))
     for i, name in enumerate(sorted_names):
         sort_name_map[name] = str(i + 1).zfill(_adjuster)
-    for file_meta in files_metadata:
+    dbmtimes = mtime_store.get_many([x['path'] for x in files_metadata])
+    for file_meta, dbmtime in zip(files_metadata, dbmtimes):
         path = file_meta['path']
         isdir = storage_client.is_dir(path) if req_path != '/' else True
         mtime = storage_client.get_mtime(path)
-        dbmtime = redis_db.get(path)
         if not isdir or not dbmtime or float(dbmtime) < float(mtime):
             need_update = True
         else:
@@ -1,9 +1,16 @@
 from flask import render_template, Blueprint, jsonify, current_app, request
 from flask_login import login_required
 from celery.result import AsyncResult
-from app.extensions import fc_handler, storage_client, redis_db, limiter
-from app.utils import getLogger, manual_scan_dest_pathlist, manual_scan_deleted_pathlist
-from app.tasks import async_filechange_to_other_device
+from app.extensions import fc_handler, storage_client, mtime_store, limiter
+from app.utils import (
+    getLogger,
+    manual_scan_dest_pathlist,
+    manual_scan_deleted_pathlist,
+    manual_scan_moved_pathlist,
+    media_clients_stats,
+    scanner_registry,
+)
+from app.tasks import async_filechange_to_other_device, consume_filechange_events
 import functools
 import os
 
@@ -42,18 +49,47 @@ def get_task_status(task_id):
     return jsonify(response)
 
 
-def add_change2fc_handler(action_cn, src_file, dest_file, src_func, dest_func):
+# 网盘接口的限流状态
+@index_bp.route('/storage_stats', methods=['GET'])
+@login_required
+def get_storage_stats():
+    return jsonify({'current': storage_client.stats(), 'processes': storage_client.published_stats()})
+
+
+# 媒体服务器的熔断状态、请求延迟及媒体库缓存
+@index_bp.route('/media_servers_stats', methods=['GET'])
+@login_required
+def get_media_servers_stats():
+    return jsonify({'clients': media_clients_stats(), 'scanners': scanner_registry.stats()})
+
+
+# 使媒体库缓存失效，下一次扫描前重新获取媒体库
+@index_bp.route('/media_servers/invalidate', methods=['POST'])
+@login_required
+def invalidate_media_servers():
+    server_type = (request.get_json(silent=True) or {}).get('server_type')
+    count = scanner_registry.invalidate(server_type)
+    return jsonify(status='success', message=f"已使{count}个媒体服务器的媒体库缓存失效")
+
+
+# 文件变更事件stream的积压及待确认数
+@index_bp.route('/filechange_stream_stats', methods=['GET'])
+@login_required
+def get_filechange_stream_stats():
+    if fc_handler.stream is None:
+        return jsonify(enabled=False)
+    return jsonify(enabled=True, **fc_handler.stream.stats())
+
+
+def add_change2fc_handler(action_cn, src_file, dest_file, src_func, dest_func, move_func):
     '''
     if action_cn in ["移动", "重命名", "创建", "删除"]:
         fc_handler.add_change(source_file)
         fc_handler.add_change(destination_file)
     '''
-    if action_cn == "移动":
-        fc_handler.add_change(src_file, _func=src_func, src_file_flag=True)
-        fc_handler.add_change(dest_file, _func=dest_func)
-    elif action_cn == "重命名":
-        fc_handler.add_change(src_file, _func=src_func, src_file_flag=True)
-        fc_handler.add_change(dest_file, _func=dest_func)
+    if action_cn in ("移动", "重命名"):
+        # 在本地移动strm目录树，不再删除后重新生成
+        fc_handler.add_move(src_file, dest_file, _func=move_func, src_func=src_func, dest_func=dest_func)
     elif action_cn == "创建":
         fc_handler.add_change(src_file, _func=dest_func)
     elif action_cn == "删除":
@@ -74,17 +110,25 @@ def file_noify():
         return jsonify({"状态": "错误", "消息": "无效的 JSON 数据"}), 400
 
     notifications = []
+    events = []
+    invalidations = []
     manual_scan_pathlist_func = functools.partial(
         manual_scan_dest_pathlist,
         servers_cfg=current_app.config['MEDIA_SERVERS'],
         storage_client=storage_client,
-        db=redis_db,
+        db=mtime_store,
     )
     manual_scan_deleted_pathlist_func = functools.partial(
         manual_scan_deleted_pathlist,
         servers_cfg=current_app.config['MEDIA_SERVERS'],
         storage_client=storage_client,
-        db=redis_db,
+        db=mtime_store,
+    )
+    manual_scan_moved_pathlist_func = functools.partial(
+        manual_scan_moved_pathlist,
+        servers_cfg=current_app.config['MEDIA_SERVERS'],
+        storage_client=storage_client,
+        db=mtime_store,
     )
     for item in data.get("data", []):
         source_file = item.get("source_file", "未知路径")
@@ -92,6 +136,10 @@ def file_noify():
         src_ext = os.path.splitext(source_file)[1]
         action_cn = fc_handler.translate_action(item.get("action", "未知"), source_file, destination_file)
         is_dir_cn = "目录" if item.get("is_dir") == "true" else "文件"
+        # 使变更路径及其祖先目录的网盘接口缓存失效，目录被移动/删除时其子孙同时失效
+        for changed_path in (source_file, destination_file):
+            if changed_path.startswith('/'):
+                invalidations.append((changed_path, is_dir_cn == "目录"))
         # 过滤“文件变更”
         path_not_allowed = True
         for kw in fc_handler.allowed_keywords:
@@ -106,15 +154,31 @@ def file_noify():
         notification = {"动作": action_cn, "类型": is_dir_cn, "源路径": source_file, "目标路径": destination_file}
         notifications.append(notification)
 
+        if fc_handler.stream is not None:
+            events.append({"action": action_cn, "src": source_file, "dest": destination_file})
+            continue
         # 根据操作记录目录变动
         add_change2fc_handler(
-            action_cn, source_file, destination_file, manual_scan_deleted_pathlist_func, manual_scan_pathlist_func
+            action_cn,
+            source_file,
+            destination_file,
+            manual_scan_deleted_pathlist_func,
+            manual_scan_pathlist_func,
+            manual_scan_moved_pathlist_func,
         )
 
+    # 本次请求的所有失效路径一次性发布
+    storage_client.invalidate_cache_many(invalidations)
+
     # 打印通知信息
     if len(notifications) > 0:
         logger.warning(f"收到文件变更通知： {notifications}")
 
+    # 写入redis stream，等待timer_interval秒收集后续的变更，再由celery worker合并处理
+    if fc_handler.stream is not None and fc_handler.stream.append(events) > 0:
+        if fc_handler.stream.schedule_once(fc_handler.wait_time):
+            consume_filechange_events.apply_async(countdown=fc_handler.wait_time)
+
     # 发送文件变更通知到其他设备
     if fc_handler.sync_other_device_enabled:
         # fc_handler.sync_filechange_to_other_device(request.url, data)
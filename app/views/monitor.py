@@ -2,7 +2,7 @@ from datetime import datetime
 from flask import Blueprint, render_template, request, jsonify, current_app
 from flask_login import login_required
 from app.database import MonitoredFolder
-from app.extensions import sqlite_db, scheduler, redis_db, storage_client
+from app.extensions import sqlite_db, scheduler, mtime_store, storage_client
 
 from app.tasks import mtime_updating, manual_scan, manual_scan_bg
 from app.utils import (
@@ -14,6 +14,8 @@ from app.utils import (
     create_folder_scheduler,
     sort_list_by_pinyin,
     str2bool,
+    timestamp_to_datetime,
+    ScanCheckpoint,
 )
 
 monitor_bp = Blueprint('index', __name__, url_prefix='/monitor')
@@ -93,7 +95,7 @@ def monitored_folder_add():
             servers_cfg=current_app.config['MEDIA_SERVERS'],
             scheduler=scheduler,
             storage_client=storage_client,
-            db=redis_db,
+            db=mtime_store,
         )
         message = f"监控目录[{folder}]已添加！"
         # 根据条件来更新mtime
@@ -158,7 +160,7 @@ def monitored_folder_edit():
             servers_cfg=current_app.config['MEDIA_SERVERS'],
             scheduler=scheduler,
             storage_client=storage_client,
-            db=redis_db,
+            db=mtime_store,
         )
         logger.info(message)
         rval = True
@@ -194,7 +196,7 @@ def monitered_folder_edit_status():
                     servers_cfg=current_app.config['MEDIA_SERVERS'],
                     scheduler=scheduler,
                     storage_client=storage_client,
-                    db=redis_db,
+                    db=mtime_store,
                 )
         message = f"监控目录[{folder}]已{'启用' if new_enabled else '禁用'}！"
         rval = True
@@ -221,6 +223,13 @@ def monitored_folder_delete():
     # 移除该目录的定时任务
     if scheduler.get_job(folder):
         scheduler.remove_job(folder)
+    # 丢弃该目录的快照及自适应间隔
+    snapshot = mtime_store.snapshot(folder, storage_client)
+    if snapshot is not None:
+        snapshot.discard()
+    adaptive = mtime_store.adaptive_polling(folder, storage_client)
+    if adaptive is not None:
+        adaptive.discard()
     message = f"监控目录[{folder}]已删除！"
     logger.warning(message)
     return jsonify(status='success', message=message)
@@ -239,6 +248,11 @@ def monitored_folder_list():
             next_run_time = (job.next_run_time).strftime("%m-%d %H:%M:%S")
         else:
             next_run_time = "-"
+        adaptive = mtime_store.adaptive_polling(res.folder, storage_client)
+        if adaptive is not None:
+            adaptive_interval, adaptive_detail = adaptive.describe()
+        else:
+            adaptive_interval, adaptive_detail = "-", ""
         folders.append(
             {
                 'name': res.folder,
@@ -247,6 +261,8 @@ def monitored_folder_list():
                 'interval': res.interval,
                 'offset': res.offset,
                 'next_run_time': next_run_time,
+                'adaptive_interval': adaptive_interval,
+                'adaptive_detail': adaptive_detail,
                 # 'sort_index': sorted_name_map[k],
             }
         )
@@ -308,6 +324,33 @@ def scan_folder_unconditionally():
         rval = False
     # '''
     '''
-    rval, message = manual_scan(folder, current_app.config['MEDIA_SERVERS'], storage_client, redis_db)
+    rval, message = manual_scan(folder, current_app.config['MEDIA_SERVERS'], storage_client, mtime_store)
     # '''
     return jsonify(status='success' if rval else 'error', message=message)
+
+
+@monitor_bp.route('/checkpoints/', methods=['GET'])
+@login_required
+def checkpoint_list():
+    checkpoints = ScanCheckpoint.list_all(mtime_store)
+    for cp in checkpoints:
+        cp['saved_at'] = timestamp_to_datetime(cp['saved_at'])
+    return jsonify(checkpoints)
+
+
+@monitor_bp.route('/checkpoints/', methods=['DELETE'])
+@login_required
+def checkpoint_discard():
+    schema = FolderBaseSchema()
+    try:
+        data = schema.load(request.json)
+    except Exception as e:
+        return jsonify(status='error', message=str(e))
+    folder = data['folder']
+    if ScanCheckpoint.discard_folder(mtime_store, folder):
+        message = f"目录[{folder}]的检查点已丢弃！"
+        logger.warning(message)
+        return jsonify(status='success', message=message)
+    else:
+        message = f"目录[{folder}]没有检查点！"
+        return jsonify(status='error', message=message)